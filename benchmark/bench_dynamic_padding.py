@@ -0,0 +1,63 @@
+import sys
+sys.path += ['./']
+import os
+import argparse
+import time
+import torch
+from models import MSMarcoConfigDict
+from dataloader import EmbeddingCache, GetProcessingFn, GetInferenceCollateFn
+
+# encode the first num_records records of a store, returns (records/s, real tokens/s)
+def encode_store(args, model, path, query):
+    with EmbeddingCache(path) as cache:
+        records = [r for k in range(min(args.num_records, len(cache))) for r in GetProcessingFn(args, query)(cache[k], k)]
+    collate_fn = GetInferenceCollateFn(args, query=query)
+    batches = [collate_fn(records[i:i + args.batch_size]) for i in range(0, len(records), args.batch_size)]
+    real_tokens = sum(passage_len for passage_len, _, _ in records)
+    emb_fn = model.query_emb if query else model.body_emb
+    start = time.time()
+    with torch.no_grad():
+        for batch in batches:
+            inputs = {"input_ids": batch[0].to(args.device), "attention_mask": batch[1].to(args.device)}
+            if args.pack_length > 0:
+                inputs.update({"segment_positions": batch[3].to(args.device), "cls_index": batch[4].to(args.device)})
+            emb_fn(**inputs)
+    if args.device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.time() - start
+    return len(records) / elapsed, real_tokens / elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default="./data/MSMARCO/preprocessed", type=str, help="The preprocessed data dir",)
+    parser.add_argument("--model_type", default="rdot_nll", type=str,)
+    parser.add_argument("--model_name_or_path", default="roberta-base", type=str,)
+    parser.add_argument("--num_records", default=2048, type=int, help="Records encoded from each store",)
+    parser.add_argument("--batch_size", default=64, type=int,)
+    parser.add_argument("--pad_to_multiple_of", default=8, type=int,)
+    parser.add_argument("--pack_length", default=512, type=int, help="Row length of the packed run",)
+    args = parser.parse_args()
+    args.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    configObj = MSMarcoConfigDict[args.model_type]
+    config = configObj.config_class.from_pretrained(args.model_name_or_path, num_labels=2, finetuning_task="MSMarco",)
+    args.pad_token_id = config.pad_token_id
+    model = configObj.model_class.from_pretrained(args.model_name_or_path, config=config,)
+    model.to(args.device)
+    model.eval()
+
+    # one ANN round encodes every passage, training query and dev query
+    stores = [("passages", False), ("train-query", True), ("dev-query", True)]
+    runs = [("max length padding", 0, 0), ("dynamic padding", args.pad_to_multiple_of, 0), ("packed rows", args.pad_to_multiple_of, args.pack_length)]
+    for name, pad_to_multiple_of, pack_length in runs:
+        args.pad_to_multiple_of, args.pack_length = pad_to_multiple_of, pack_length
+        round_time = 0
+        for store, query in stores:
+            path = os.path.join(args.data_dir, store)
+            records_per_s, tokens_per_s = encode_store(args, model, path, query)
+            round_time += len(EmbeddingCache(path)) / records_per_s
+            print("{}, {}: {:.1f} records/s, {:.1f} real tokens/s".format(name, store, records_per_s, tokens_per_s))
+        print("{}: {:.1f} min per ANN round (estimated, single device)".format(name, round_time / 60))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import sys
+sys.path += ['./']
+import argparse
+import time
+import numpy as np
+import torch
+from models import MSMarcoConfigDict
+from dataloader import collate_records
+
+# synthetic (passage_len, passage) records, lengths uniform in [min_len, max_len], padded to max_len
+def make_records(rng, num, min_len, max_len):
+    records = []
+    for _ in range(num):
+        passage_len = rng.randint(min_len, max_len + 1)
+        passage = np.ones(max_len, dtype=np.int32) # roberta <pad>
+        passage[:passage_len] = rng.randint(3, 30000, size=passage_len)
+        records.append((passage_len, passage))
+    return records
+
+def make_batch(args, rng):
+    query = collate_records(make_records(rng, args.batch_size, 4, args.max_query_length), True, pad_to_multiple_of=8)
+    pos = collate_records(make_records(rng, args.batch_size, args.min_passage_length, args.max_seq_length), False, pad_to_multiple_of=8)
+    neg = collate_records(make_records(rng, args.batch_size * args.negative_sample, args.min_passage_length, args.max_seq_length), False, pad_to_multiple_of=8)
+    neg_mask = torch.ones((args.batch_size, args.negative_sample), dtype=torch.long)
+    return {"query_ids": query[0], "attention_mask_q": query[1],
+            "input_ids_a": pos[0], "attention_mask_a": pos[1],
+            "input_ids_b": neg[0], "attention_mask_b": neg[1],
+            "neg_mask": neg_mask}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", default="rdot_nll", type=str,)
+    parser.add_argument("--model_name_or_path", default="roberta-base", type=str,)
+    parser.add_argument("--random_init", default=False, action="store_true", help="Randomly initialized roberta-base sized model, no download",)
+    parser.add_argument("--batch_size", default=8, type=int,)
+    parser.add_argument("--negative_sample", default=1, type=int,)
+    parser.add_argument("--max_query_length", default=32, type=int,)
+    parser.add_argument("--min_passage_length", default=40, type=int,)
+    parser.add_argument("--max_seq_length", default=160, type=int,)
+    parser.add_argument("--steps", default=10, type=int,)
+    parser.add_argument("--num_threads", default=0, type=int, help="torch CPU threads, 0 for the default",)
+    parser.add_argument("--seed", default=42, type=int,)
+    args = parser.parse_args()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    configObj = MSMarcoConfigDict[args.model_type]
+    if args.random_init:
+        config = configObj.config_class(vocab_size=50265, max_position_embeddings=514, type_vocab_size=1, num_labels=2)
+        model = configObj.model_class(config)
+    else:
+        config = configObj.config_class.from_pretrained(args.model_name_or_path, num_labels=2, finetuning_task="MSMarco",)
+        model = configObj.model_class.from_pretrained(args.model_name_or_path, config=config,)
+
+    rng = np.random.RandomState(args.seed)
+    batches = [make_batch(args, rng) for _ in range(args.steps + 1)]
+
+    # same loss on every path, dropout off
+    model.eval()
+    with torch.no_grad():
+        losses = {fused_encoder: model(**batches[0], fused_encoder=fused_encoder)[0].item() for fused_encoder in ["none", "passages", "all"]}
+    print("losses:", losses)
+
+    # training steps: forward and backward, the first batch warms up
+    model.train()
+    for fused_encoder in ["none", "passages", "all"]:
+        model(**batches[0], fused_encoder=fused_encoder)[0].backward()
+        start = time.time()
+        for batch in batches[1:]:
+            model.zero_grad()
+            model(**batch, fused_encoder=fused_encoder)[0].backward()
+        elapsed = time.time() - start
+        print("{}: {:.1f} ms/step, {:.1f} queries/s".format(fused_encoder, 1000 * elapsed / args.steps, args.steps * args.batch_size / elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import sys
+sys.path += ['./', './data']
+import argparse
+import random
+import time
+from models import MSMarcoConfigDict
+from msmarco_data import PassagePreprocessingFn, PassageBatchPreprocessingFn, FastBatchEncoder
+
+# synthetic passage collection: "p_id \t text" lines with a zipf-like word distribution
+def make_collection(num_docs, min_words, max_words, seed):
+    rng = random.Random(seed)
+    vocab = ["word{}".format(i) for i in range(5000)] + ["the", "of", "and", "a", "to", "in", "is", "was", "for", "on"]
+    weights = [1.0 / (i + 1) for i in range(len(vocab))]
+    lines = []
+    for p_id in range(num_docs):
+        words = rng.choices(vocab, weights=weights, k=rng.randint(min_words, max_words))
+        lines.append("{}\t{}\n".format(p_id, " ".join(words).capitalize() + "."))
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", default="rdot_nll", type=str,)
+    parser.add_argument("--model_name_or_path", default="roberta-base", type=str,)
+    parser.add_argument("--max_seq_length", default=512, type=int,)
+    parser.add_argument("--max_doc_character", default=10000, type=int,)
+    parser.add_argument("--num_docs", default=20000, type=int, help="Number of synthetic passages",)
+    parser.add_argument("--min_words", default=20, type=int,)
+    parser.add_argument("--max_words", default=120, type=int,)
+    parser.add_argument("--tokenize_batch_size", default=1000, type=int,)
+    parser.add_argument("--seed", default=42, type=int,)
+    args = parser.parse_args()
+    args.data_type = 1
+    args.token_dtype = "int32"
+
+    configObj = MSMarcoConfigDict[args.model_type]
+    tokenizer = configObj.tokenizer_class.from_pretrained(args.model_name_or_path, do_lower_case=False, cache_dir=None,)
+    lines = make_collection(args.num_docs, args.min_words, args.max_words, args.seed)
+
+    start = time.time()
+    slow_records = [PassagePreprocessingFn(args, line, tokenizer) for line in lines]
+    slow_time = time.time() - start
+    print("slow engine: {:.1f} docs/s".format(len(lines) / slow_time))
+
+    encoder = FastBatchEncoder(tokenizer)
+    start = time.time()
+    fast_records = [PassageBatchPreprocessingFn(args, lines[i:i + args.tokenize_batch_size], encoder) for i in range(0, len(lines), args.tokenize_batch_size)]
+    fast_time = time.time() - start
+    print("fast engine: {:.1f} docs/s ({:.1f}x)".format(len(lines) / fast_time, slow_time / fast_time))
+
+    print("identical records:", b''.join(slow_records) == b''.join(fast_records))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import sys
+sys.path += ['./']
+import os
+import argparse
+import random
+import time
+import numpy as np
+from dataloader import EmbeddingCache
+from utils.util import order_triplets
+from utils.ann_data import load_ann_data
+
+# ann_training_data rows as (qid, pos_pid, [neg_pid, ...])
+def load_triplets(ann_file):
+    return [(int(row['qid']), int(row['pos']), [int(neg_pid) for neg_pid in row['neg'] if neg_pid >= 0]) for row in load_ann_data(ann_file)]
+
+# synthetic triplets with skewed negatives: hard negatives repeat across queries
+def make_triplets(num_triplets, num_queries, num_passages, negative_sample, seed):
+    rng = np.random.RandomState(seed)
+    popular = rng.randint(0, num_passages, size=max(1, num_passages // 100))
+    triplets = []
+    for _ in range(num_triplets):
+        negs = [int(popular[rng.randint(len(popular))]) if rng.rand() < 0.5 else int(rng.randint(num_passages)) for _ in range(negative_sample)]
+        triplets.append((int(rng.randint(num_queries)), int(rng.randint(num_passages)), negs))
+    return triplets
+
+# evict the store from the page cache, so every run starts cold
+def drop_page_cache(path):
+    fd = os.open(path, os.O_RDONLY)
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    os.close(fd)
+
+# the reads of GetTripletTrainingDataProcessingFn: the query, then the positive and negatives in one gather
+def read_triplets(args, triplets):
+    for path in (args.query_path, args.passage_path):
+        drop_page_cache(path)
+    records = 0
+    with EmbeddingCache(args.query_path, mmap=args.mmap_cache) as query_cache, EmbeddingCache(args.passage_path, mmap=args.mmap_cache) as passage_cache:
+        start = time.time()
+        for qid, pos_pid, neg_pids in triplets:
+            query_cache[qid]
+            passage_cache.get_batch([pos_pid] + neg_pids)
+            records += 2 + len(neg_pids)
+        elapsed = time.time() - start
+    return records / elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default="./data/MSMARCO/preprocessed", type=str, help="The preprocessed data dir",)
+    parser.add_argument("--ann_file", default=None, type=str, help="ann_training_data_N(.npy) to replay, synthetic triplets if not given",)
+    parser.add_argument("--num_triplets", default=100000, type=int, help="Number of synthetic triplets",)
+    parser.add_argument("--negative_sample", default=1, type=int,)
+    parser.add_argument("--shuffle_window", default=1024, type=int,)
+    parser.add_argument("--mmap_cache", default=False, action="store_true",)
+    parser.add_argument("--seed", default=42, type=int,)
+    args = parser.parse_args()
+    args.query_path = os.path.join(args.data_dir, "train-query")
+    args.passage_path = os.path.join(args.data_dir, "passages")
+
+    if args.ann_file is not None:
+        triplets = load_triplets(args.ann_file)
+    else:
+        triplets = make_triplets(args.num_triplets, len(EmbeddingCache(args.query_path)), len(EmbeddingCache(args.passage_path)), args.negative_sample, args.seed)
+    keys = [min([pos_pid] + neg_pids) for _, pos_pid, neg_pids in triplets]
+
+    for ann_order in ["random", "locality"]:
+        random.seed(args.seed)
+        ordered = [triplets[i] for i in order_triplets(keys, ann_order, args.shuffle_window)]
+        print("{}: {:.1f} records/s (cold page cache)".format(ann_order, read_triplets(args, ordered)))
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,12 @@
 import sys
+sys.path += ['./']
 import os
 import csv
 import numpy as np
 import argparse
 import json
 import random
+from utils.ann_data import save_ann_data
 
 def load_positive_ids(args):
     training_query_positive_id = {}
@@ -30,7 +32,7 @@ def GenerateNegativePassaageID(pos_passage_idx, all_passage_idx, negative_sample
         neg_passage_idx.append(neg_pid)
     return neg_passage_idx
 
-# ann_dir/ann_training_data_[output_num]-(query_id, pos_pid, neg_pid)
+# ann_dir/ann_training_data_[output_num].npy-(query_id, pos_pid, neg_pids), see utils/ann_data.py
 # ann_dir/ann_ndcg_[output_num]-({ndcg: dev_ndcg, checkpoint: checkpoint_path})
 # training_query_positive_id: {query_id: passage_id, ...}
 def generate_bm25_ann(args):
@@ -39,15 +41,13 @@ def generate_bm25_ann(args):
     checkpoint_path = ""
     if not os.path.exists(args.ann_dir):
         os.makedirs(args.ann_dir)
-    train_data_output_path = os.path.join(args.ann_dir, "ann_training_data_" + str(output_num))
-    with open(train_data_output_path, 'w') as f:
-        all_passage_idx = list(set(training_query_positive_id.values()))
-        random.shuffle(all_passage_idx)
-        for query_idx, passage_idx in training_query_positive_id.items():
-            neg_passage_idx = GenerateNegativePassaageID(passage_idx, all_passage_idx)
-            # print(neg_passage_idx)
-            # input('check')
-            f.write("{}\t{}\t{}\n".format(query_idx, passage_idx, ','.join(str(neg_pid) for neg_pid in neg_passage_idx)))
+    train_data_output_path = os.path.join(args.ann_dir, "ann_training_data_" + str(output_num) + ".npy")
+    all_passage_idx = list(set(training_query_positive_id.values()))
+    random.shuffle(all_passage_idx)
+    query_ids = list(training_query_positive_id.keys())
+    pos_pids = [training_query_positive_id[query_idx] for query_idx in query_ids]
+    neg_pids = [GenerateNegativePassaageID(passage_idx, all_passage_idx) for passage_idx in pos_pids]
+    save_ann_data(train_data_output_path, query_ids, pos_pids, neg_pids)
     # meta info
     ndcg_output_path = os.path.join(args.ann_dir, "ann_ndcg_" + str(output_num))
     with open(ndcg_output_path, 'w') as f:
@@ -6,6 +6,7 @@ import tarfile
 import logging
 import os
 import pathlib
+import shutil
 import wget
 from typing import Tuple
 
@@ -90,12 +91,9 @@ MSMARCO_MAP = {
 def unpack(gzip_file: str, out_file: str, zip_format: str = ".gz"):
     logger.info("Uncompressing %s", gzip_file)
     if zip_format == ".gz":
-        input = gzip.GzipFile(gzip_file, "rb")
-        s = input.read()
-        input.close()
-        output = open(out_file, "wb")
-        output.write(s)
-        output.close()
+        # stream in 16MB chunks instead of holding the whole file in memory
+        with gzip.GzipFile(gzip_file, "rb") as input, open(out_file, "wb") as output:
+            shutil.copyfileobj(input, output, 16 * 1024 * 1024)
     elif zip_format == ".tar.gz":
         t = tarfile.open(gzip_file)
         out_file = os.path.dirname(out_file)
@@ -104,7 +102,7 @@ def unpack(gzip_file: str, out_file: str, zip_format: str = ".gz"):
 
 
 def download_resource(
-    data_name: str, s3_url: str, original_ext: str, compressed: bool, resource_key: str, out_dir: str, zip_format: str
+    data_name: str, s3_url: str, original_ext: str, compressed: bool, resource_key: str, out_dir: str, zip_format: str, keep_compressed: bool = False
     ) -> Tuple[str, str]:
     logger.info("Requested resource from %s", s3_url)
     
@@ -136,12 +134,22 @@ def download_resource(
         logger.info("File already exist %s", local_file_uncompressed)
         return save_root, local_file_uncompressed
 
+    # msmarco_data.py reads .gz files directly, so single .gz files can be kept as they are
+    keep_compressed = keep_compressed and compressed and zip_format == ".gz"
+    local_file_compressed = local_file_uncompressed + ".gz"
+    if keep_compressed and os.path.exists(local_file_compressed):
+        logger.info("File already exist %s", local_file_compressed)
+        return save_root, local_file_compressed
+
     local_file = os.path.abspath(os.path.join(save_root, path_names[-1] + (".tmp" if compressed else original_ext)))
 
     wget.download(s3_url, out=local_file)
     logger.info("Downloaded to %s", local_file)
 
-    if compressed:
+    if keep_compressed:
+        os.rename(local_file, local_file_compressed)
+        local_file = local_file_compressed
+    elif compressed:
         uncompressed_file = os.path.join(save_root, path_names[-1] + original_ext)
         unpack(local_file, uncompressed_file, zip_format)
         os.remove(local_file)
@@ -162,7 +170,7 @@ def download_file(s3_url: str, out_dir: str, file_name: str):
     logger.info("Downloaded to %s", local_file)
 
 
-def download(data_name: str, resource_map: dict, resource_key: str, out_dir: str = None):
+def download(data_name: str, resource_map: dict, resource_key: str, out_dir: str = None, keep_compressed: bool = False):
     if not os.path.exists(out_dir):
         os.makedirs(out_dir) 
     if resource_key not in resource_map:
@@ -171,7 +179,7 @@ def download(data_name: str, resource_map: dict, resource_key: str, out_dir: str
         print("Match by prefix resources: ", resources)
         if resources:
             for key in resources:
-                download(data_name, resource_map, key, out_dir)
+                download(data_name, resource_map, key, out_dir, keep_compressed)
         else:
             logger.info("no resources found for specified key")
             raise ValueError("Error: No resources found for specified key!")
@@ -193,6 +201,7 @@ def download(data_name: str, resource_map: dict, resource_key: str, out_dir: str
                     "{}_{}".format(resource_key, i),
                     out_dir,
                     zip_format,
+                    keep_compressed,
                 )
                 data_files.append(local_file)
         else:
@@ -204,6 +213,7 @@ def download(data_name: str, resource_map: dict, resource_key: str, out_dir: str
                 resource_key,
                 out_dir,
                 zip_format,
+                keep_compressed,
             )
             data_files.append(local_file)
 
@@ -223,6 +233,7 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--data_name", default=["MSMARCO"], type=list, help="The list of dataset name")
     parser.add_argument("--output_dir", default="./data", type=str, help="The output directory to download file")
+    parser.add_argument("--keep_compressed", default=False, action="store_true", help="Keep .gz files compressed instead of unpacking them, msmarco_data.py streams them directly")
     args = parser.parse_args()
     
     for data_name in args.data_name:
@@ -233,7 +244,7 @@ def main():
             logger.info("resource name %s", *resource)
             print("Download resources: ", resource)
             for resource_key in resource:
-                download(data_name, RESOURCE_MAP, resource_key, args.output_dir)
+                download(data_name, RESOURCE_MAP, resource_key, args.output_dir, args.keep_compressed)
         else:
             logger.info("no dataset support for %s", data_name)
             raise NotImplementedError("Error: No dataset support for data name!")
@@ -3,37 +3,251 @@ sys.path += ['./']
 import os
 import gzip
 import csv
-import pickle
 import argparse
 import json
 import glob
+import hashlib
+import time
+import shutil
+import queue
+import tempfile
+import subprocess
+import io
 import numpy as np
 from models import MSMarcoConfigDict, ALL_MODELS
-from multiprocessing import Process
+from utils.id_map import IdMap
+from multiprocessing import Process, Queue, Pipe
 
-# input the doc then use tokenizer to split each word id
-def tokenize_to_file(args, i, num_process, in_path, out_path, line_fn):
-    configObj = MSMarcoConfigDict[args.model_type] # rdot_nll
-    tokenizer = configObj.tokenizer_class.from_pretrained(args.model_name_or_path, do_lower_case=args.do_lower_case, cache_dir=None,)
+# split in_path into num_process byte ranges whose boundaries fall on line starts
+def get_byte_ranges(in_path, num_process):
+    file_size = os.path.getsize(in_path)
+    boundaries = [0]
+    with open(in_path, 'rb') as f:
+        for i in range(1, num_process):
+            pos = max(file_size * i // num_process, boundaries[-1])
+            if 0 < pos < file_size:
+                f.seek(pos - 1)
+                f.readline() # move to the first line starting at or after pos
+                pos = f.tell()
+            boundaries.append(min(pos, file_size))
+    boundaries.append(file_size)
+    return [(boundaries[i], boundaries[i + 1]) for i in range(num_process)]
+
+# yield the lines of in_path, .gz files are decompressed by pigz when it is installed
+# (reading, inflating and checking run on separate threads) and by gzip otherwise
+def read_input_lines(in_path):
+    if in_path[-2:] == "gz" and shutil.which("pigz") is not None:
+        proc = subprocess.Popen(["pigz", "-dc", in_path], stdout=subprocess.PIPE)
+        try:
+            yield from io.TextIOWrapper(proc.stdout, encoding='utf-8')
+        finally:
+            proc.stdout.close()
+            proc.wait()
+        if proc.returncode != 0:
+            raise RuntimeError("pigz failed to decompress {}".format(in_path))
+    else:
+        with open(in_path, 'r', encoding='utf-8') if in_path[-2:] != "gz" else gzip.open(in_path, 'rt', encoding='utf8') as in_f:
+            yield from in_f
+
+# decompress in_path once and hand chunks of lines to the tokenization workers through the bounded line_queue,
+# one None per worker marks the end of the stream
+def feed_lines(in_path, line_queue, num_process, chunk_lines=1000):
+    chunk = []
+    for line in read_input_lines(in_path):
+        chunk.append(line)
+        if len(chunk) == chunk_lines:
+            line_queue.put(chunk)
+            chunk = []
+    if chunk:
+        line_queue.put(chunk)
+    for _ in range(num_process):
+        line_queue.put(None)
+
+def read_queue_lines(line_queue):
+    while True:
+        chunk = line_queue.get()
+        if chunk is None:
+            break
+        yield from chunk
 
-    with open(in_path, 'r', encoding='utf-8') if in_path[-2:] != "gz" else gzip.open(in_path, 'rt', encoding='utf8') as in_f,\
-            open('{}_split{}'.format(out_path, i), 'wb') as out_f: # i is the index of processing
-        for idx, line in enumerate(in_f):
+# read the lines of worker i: either its own byte range, or every num_process-th line of the whole file
+def read_shard_lines(i, num_process, in_path, byte_range=None):
+    if byte_range is not None:
+        start, end = byte_range
+        with open(in_path, 'rb') as in_f:
+            in_f.seek(start)
+            pos = start
+            for line in in_f:
+                if pos >= end:
+                    break
+                pos += len(line)
+                yield line.decode('utf-8')
+    else:
+        for idx, line in enumerate(read_input_lines(in_path)):
             if idx % num_process != i: # distribute file to correspoinding processing
                 continue
-            # transfer each line to "p_id.to_bytes(8, 'big') + passage_len.to_bytes(4, 'big') + 
-            # content=np.array(input_id_b, np.int32).tobytes(): max length"
-            out_f.write(line_fn(args, line, tokenizer))
+            yield line
+
+def load_tokenizer(args):
+    configObj = MSMarcoConfigDict[args.model_type] # rdot_nll
+    return configObj.tokenizer_class.from_pretrained(args.model_name_or_path, do_lower_case=args.do_lower_case, cache_dir=None,)
+
+def get_split_path(out_path, i, suffix=""):
+    return '{}_split{}{}'.format(out_path, i, suffix) # i is the index of processing
+
+# tokenize lines with line_fn and yield one "p_id.to_bytes(8, 'big') + passage_len.to_bytes(4, 'big') + 
+# content=np.array(input_id_b, np.int32).tobytes(): max length" record at a time
+def tokenize_lines(args, lines, line_fn, tokenizer, record_size):
+    if args.tokenizer_engine == "fast":
+        # line_fn is a batch fn here, it takes a list of lines
+        batch = []
+        for line in lines:
+            batch.append(line)
+            if len(batch) == args.tokenize_batch_size:
+                records = line_fn(args, batch, tokenizer)
+                for start in range(0, len(records), record_size):
+                    yield records[start:start + record_size]
+                batch = []
+        if batch:
+            records = line_fn(args, batch, tokenizer)
+            for start in range(0, len(records), record_size):
+                yield records[start:start + record_size]
+    else:
+        for line in lines:
+            yield line_fn(args, line, tokenizer)
+
+# input the doc then use tokenizer to split each word id
+# worker i reports (i, record count, token count) on count_queue and receives (first record, first token) of
+# its region in the preallocated store on start_conn, ids, lengths, line digests and token digests of its records go to small sidecar files
+# lines come from line_queue when the parent streams a compressed input, from in_path otherwise
+def tokenize_to_file(args, i, num_process, in_path, out_path, line_fn, id_fn, record_size, packed, keep_ids, byte_range, count_queue, start_conn, line_queue=None):
+    tokenizer = load_tokenizer(args)
+    if args.tokenizer_engine == "fast":
+        tokenizer = FastBatchEncoder(tokenizer)
+
+    start_time = time.time()
+    lines = read_queue_lines(line_queue) if line_queue is not None else read_shard_lines(i, num_process, in_path, byte_range)
+    if keep_ids is not None:
+        lines = (line for line in lines if id_fn(args, line) in keep_ids)
+    payload_size = record_size - 8 # the id is not stored
+    itemsize = np.dtype(args.token_dtype).itemsize
+    ids, lengths, digests, token_digests = [], [], [], []
+
+    def digest_lines(lines):
+        for line in lines:
+            digests.append(line_digest(line))
+            yield line
+    if line_queue is None and not packed:
+        # fixed-size records of a shard that can be read twice: count first, then tokenize straight into the store
+        record_count = sum(1 for _ in lines)
+        count_queue.put((i, record_count, 0))
+        record_start, _ = start_conn.recv()
+        if record_count > 0:
+            region = np.memmap(out_path, dtype=np.uint8, mode='r+', offset=record_start * payload_size, shape=(record_count * payload_size,))
+            lines = read_shard_lines(i, num_process, in_path, byte_range)
+            if keep_ids is not None:
+                lines = (line for line in lines if id_fn(args, line) in keep_ids)
+            for k, record in enumerate(tokenize_lines(args, digest_lines(lines), line_fn, tokenizer, record_size)):
+                ids.append(int.from_bytes(record[:8], 'big'))
+                passage_len = int.from_bytes(record[8:12], 'big')
+                lengths.append(passage_len)
+                token_digests.append(token_digest(record[12:12 + passage_len * itemsize]))
+                region[k * payload_size:(k + 1) * payload_size] = np.frombuffer(record, dtype=np.uint8, offset=8)
+            region.flush()
+            del region
+    else:
+        # packed records (the region size is a token count, only known after tokenizing) and streamed lines
+        # (read once) spill the payload to the split file first
+        with open(get_split_path(out_path, i), 'wb') as out_f:
+            for record in tokenize_lines(args, digest_lines(lines), line_fn, tokenizer, record_size):
+                ids.append(int.from_bytes(record[:8], 'big'))
+                passage_len = int.from_bytes(record[8:12], 'big')
+                lengths.append(passage_len)
+                token_digests.append(token_digest(record[12:12 + passage_len * itemsize]))
+                out_f.write(record[12:12 + passage_len * itemsize] if packed else record[8:])
+        count_queue.put((i, len(ids), sum(lengths)))
+        record_start, token_start = start_conn.recv()
+        with open(get_split_path(out_path, i), 'rb') as in_f, open(out_path, 'r+b') as out_f:
+            out_f.seek(token_start * itemsize if packed else record_start * payload_size)
+            shutil.copyfileobj(in_f, out_f, 16 * 1024 * 1024)
+    np.array(ids, dtype=np.int64).tofile(get_split_path(out_path, i, "_ids"))
+    np.array(lengths, dtype=np.int32).tofile(get_split_path(out_path, i, "_lengths"))
+    np.array(digests, dtype=np.uint64).tofile(get_split_path(out_path, i, "_digests"))
+    np.array(token_digests, dtype=np.uint64).tofile(get_split_path(out_path, i, "_token_digests"))
+    elapsed = max(time.time() - start_time, 1e-6)
+    print("worker {}: {} lines in {:.1f}s ({:.1f} lines/s)".format(i, len(ids), elapsed, len(ids) / elapsed))
 
-# multiple processing operation 
-def multi_file_process(args, num_process, in_path, out_path, line_fn):
+# multiple processing operation, the records of in_path are written to out_path after base = (records, tokens) already there
+# return ids, lengths, line digests and token digests of the new records in store order
+def multi_file_process(args, num_process, in_path, out_path, line_fn, id_fn, max_length, packed, keep_ids=None, base=(0, 0)):
+    byte_ranges = [None] * num_process
+    line_queue = None
+    feeder = None
+    if in_path[-2:] == "gz":
+        # compressed inputs have no random access: decompress them once here and stream the lines to the workers
+        line_queue = Queue(maxsize=4 * num_process)
+        feeder = Process(target=feed_lines, args=(in_path, line_queue, num_process,))
+        feeder.daemon = True # do not outlive a failed run blocked on a full queue
+        feeder.start()
+    elif args.shard_mode == "byte":
+        byte_ranges = get_byte_ranges(in_path, num_process)
+    itemsize = np.dtype(args.token_dtype).itemsize
+    record_size = 8 + 4 + max_length * itemsize
+    count_queue = Queue()
+    start_conns = []
     processes = []
     for i in range(num_process):
-        p = Process(target=tokenize_to_file, args=(args, i, num_process, in_path, out_path, line_fn,))
+        parent_conn, child_conn = Pipe()
+        start_conns.append(parent_conn)
+        p = Process(target=tokenize_to_file, args=(args, i, num_process, in_path, out_path, line_fn, id_fn, record_size, packed, keep_ids, byte_ranges[i], count_queue, child_conn, line_queue,))
         processes.append(p)
         p.start()
-    for p in processes:
-        p.join()
+
+    try:
+        counts = [None] * num_process
+        for _ in range(num_process):
+            while True:
+                try:
+                    i, record_count, token_count = count_queue.get(timeout=10)
+                    break
+                except queue.Empty:
+                    if any(p.exitcode not in (None, 0) for p in processes):
+                        raise RuntimeError("a tokenization worker failed")
+                    if feeder is not None and feeder.exitcode not in (None, 0):
+                        raise RuntimeError("failed to decompress {}".format(in_path))
+            counts[i] = (record_count, token_count)
+
+        # preallocate the store and hand every worker the start of its region
+        record_start, token_start = base
+        starts = []
+        for record_count, token_count in counts:
+            starts.append((record_start, token_start))
+            record_start += record_count
+            token_start += token_count
+        with open(out_path, 'r+b' if os.path.exists(out_path) and base[0] > 0 else 'wb') as f:
+            f.truncate(token_start * itemsize if packed else record_start * (record_size - 8))
+        for conn, start in zip(start_conns, starts):
+            conn.send(start)
+        for p in processes:
+            p.join()
+    finally:
+        # after a failure the other workers are still blocked on start_conn.recv(), and non-daemon
+        # processes would keep the interpreter from exiting
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+    if any(p.exitcode != 0 for p in processes):
+        raise RuntimeError("a tokenization worker failed")
+    if feeder is not None:
+        feeder.join()
+
+    # the id -> offset map comes from the id sidecars, the token payload is not read again
+    ids = np.concatenate([np.fromfile(get_split_path(out_path, i, "_ids"), dtype=np.int64) for i in range(num_process)])
+    lengths = np.concatenate([np.fromfile(get_split_path(out_path, i, "_lengths"), dtype=np.int32) for i in range(num_process)])
+    digests = np.concatenate([np.fromfile(get_split_path(out_path, i, "_digests"), dtype=np.uint64) for i in range(num_process)])
+    token_digests = np.concatenate([np.fromfile(get_split_path(out_path, i, "_token_digests"), dtype=np.uint64) for i in range(num_process)])
+    return ids, lengths, digests, token_digests
 
 def pad_input_ids(input_ids, max_length, pad_on_left=False, pad_token=0):
     padding_length = max_length - len(input_ids)
@@ -49,20 +263,39 @@ def pad_input_ids(input_ids, max_length, pad_on_left=False, pad_token=0):
 
     return input_ids
 
-# out_passage_path, 32, 8 + 4 + args.max_seq_length * 4
-def numbered_byte_file_generator(base_path, file_no, record_size):
-    for i in range(file_no):
-        with open('{}_split{}'.format(base_path, i), 'rb') as f:
-            while True:
-                b = f.read(record_size)
-                if not b:
-                    # eof
-                    break
-                yield b
+# Rust `tokenizers` batch encoder that reproduces tokenizer.encode(text, add_special_tokens=True, max_length=...)
+# of the slow RoBERTa tokenizer, so both engines write byte-identical records
+class FastBatchEncoder:
+    def __init__(self, tokenizer):
+        try:
+            from tokenizers import ByteLevelBPETokenizer, AddedToken
+            from tokenizers.processors import RobertaProcessing
+        except ImportError:
+            raise ImportError("Please install tokenizers (pip install tokenizers) to use --tokenizer_engine fast.")
+        self.sep_token = tokenizer.sep_token
+        self.pad_token_id = tokenizer.pad_token_id
 
-# process each line from file
-# transfer each line to "p_id.to_bytes(8, 'big') + passage_len.to_bytes(4, 'big') + content=np.array(input_id_b, np.int32).tobytes()"
-def PassagePreprocessingFn(args, line, tokenizer):
+        vocab_dir = tempfile.mkdtemp()
+        vocab_file, merges_file = tokenizer.save_vocabulary(vocab_dir)
+        self.encoder = ByteLevelBPETokenizer(vocab_file, merges_file)
+        shutil.rmtree(vocab_dir)
+        # the slow tokenizer splits on special tokens and strips the text around them
+        self.encoder.add_special_tokens([AddedToken(token, lstrip=True, rstrip=True) for token in tokenizer.all_special_tokens])
+        self.encoder.post_processor = RobertaProcessing((tokenizer.sep_token, tokenizer.sep_token_id), (tokenizer.cls_token, tokenizer.cls_token_id))
+
+    def encode_batch(self, texts, max_length):
+        self.encoder.enable_truncation(max_length=max_length)
+        return [encoding.ids for encoding in self.encoder.encode_batch(texts)]
+
+# p_id.to_bytes(8, 'big') + passage_len.to_bytes(4, 'big') + content=np.array(input_id_b, dtype).tobytes()
+def pack_record(record_id, input_ids, max_length, pad_token_id, dtype=np.int32):
+    passage_len = min(len(input_ids), max_length)
+    # expand passage with max length by using tokenizer.pad_token_id
+    input_id_b = pad_input_ids(input_ids, max_length, pad_token=pad_token_id) # keep the same seq length by padding
+    return record_id.to_bytes(8, 'big') + passage_len.to_bytes(4, 'big') + np.array(input_id_b, dtype).tobytes()
+
+# split a passage/doc line into its id and the text to tokenize
+def get_passage_text(args, line, sep_token):
     if args.data_type == 0:
         line_arr = line.split('\t')
         # doc
@@ -72,7 +305,7 @@ def PassagePreprocessingFn(args, line, tokenizer):
         p_text = line_arr[3].rstrip()
 
         #full_text = url + "<sep>" + title + "<sep>" + p_text
-        full_text = url + " "+tokenizer.sep_token+" " + title + " "+tokenizer.sep_token+" " + p_text
+        full_text = url + " "+sep_token+" " + title + " "+sep_token+" " + p_text
         # keep only first 10000 characters, should be sufficient for any
         # experiment that uses less than 500 - 1k tokens
         full_text = full_text[:args.max_doc_character]
@@ -87,130 +320,341 @@ def PassagePreprocessingFn(args, line, tokenizer):
         # keep only first 10000 characters, should be sufficient for any
         # experiment that uses less than 500 - 1k tokens
         full_text = p_text[:args.max_doc_character]
-    # tokenizer.encode: using vocab.txt from BERT change token to dict_id, and add 101=[cls] and 102=[sep] in the before and after passage
-    passage = tokenizer.encode(full_text, add_special_tokens=True, max_length=args.max_seq_length,) # return token id
-    passage_len = min(len(passage), args.max_seq_length)
-    # expand passage with max length by using tokenizer.pad_token_id
-    input_id_b = pad_input_ids(passage, args.max_seq_length, pad_token=tokenizer.pad_token_id) # keep the same seq length by padding
-
-    return p_id.to_bytes(8, 'big') + passage_len.to_bytes(4, 'big') + np.array(input_id_b, np.int32).tobytes()
+    return p_id, full_text
 
-# process each line from file
-def QueryPreprocessingFn(args, line, tokenizer):
+def get_query_text(args, line):
     line_arr = line.split('\t')
     # query
     q_id = int(line_arr[0])
     q_text = line_arr[1].rstrip()
+    return q_id, q_text
+
+# store layout read by EmbeddingCache, described by out_path + "_meta"
+# padded: fixed-size records "passage_len.to_bytes(4, 'big') + padded tokens"
+# tokens are stored as meta['type'], uint16 when the vocab fits, int32 otherwise
+# packed: a flat token array without padding plus a CSR offsets array (out_path + "_offsets.npy"),
+#         record k is tokens[offsets[k]:offsets[k + 1]]
+def load_store_meta(out_path):
+    with open(out_path + "_meta", 'r') as f:
+        return json.load(f)
+
+def save_store_meta(out_path, meta):
+    with open(out_path + "_meta", 'w') as f:
+        json.dump(meta, f)
+
+# raw id of a line without tokenizing it
+def get_passage_id(args, line):
+    p_id = line.strip().split('\t', 1)[0]
+    return int(p_id[1:]) if args.data_type == 0 else int(p_id) # remove "D" for doc
+
+def get_query_id(args, line):
+    return int(line.split('\t', 1)[0])
+
+# 64-bit content hash of a line, used by --append to find changed lines
+def line_digest(line):
+    return int.from_bytes(hashlib.blake2b(line.rstrip('\r\n').encode('utf-8'), digest_size=8).digest(), 'big')
+
+# 64-bit hash of the stored tokens of a record, used by --dedup to find duplicate passages
+def token_digest(token_bytes):
+    return int.from_bytes(hashlib.blake2b(token_bytes, digest_size=8).digest(), 'big')
+
+# out_path + "_ids.npy": raw id of each record, out_path + "_digest.npy": line digest of each record
+def save_store_index(out_path, ids, digests):
+    np.save(out_path + "_ids.npy", np.asarray(ids, dtype=np.int64))
+    np.save(out_path + "_digest.npy", np.asarray(digests, dtype=np.uint64))
+
+# deduplicated stores also map the ids in out_path + "_alias" to the offset of their canonical record, with eval_ids
+# to their own evaluation id instead (see utils.id_map.load_alias_expansion)
+def load_store_id_map(out_path, eval_ids=False):
+    ids = np.load(out_path + "_ids.npy")
+    offsets = np.arange(len(ids))
+    if load_store_meta(out_path).get('dedup', False):
+        alias = IdMap.load(out_path + "_alias")
+        alias_offsets = len(ids) + np.arange(len(alias.ids)) if eval_ids else alias.offsets
+        ids, offsets = np.concatenate([ids, alias.ids]), np.concatenate([offsets, alias_offsets])
+    return IdMap.from_arrays(ids, offsets)
 
+# out_path + "_lengths.npy": token count of each record as int16, meta['length_histogram'][n]: number of records of length n
+def save_store_lengths(out_path, meta, lengths):
+    np.save(out_path + "_lengths.npy", np.asarray(lengths, dtype=np.int16))
+    meta['length_histogram'] = np.bincount(lengths, minlength=meta['embedding_size'] + 1).tolist()
+
+# stores built before the lengths sidecar existed: take them from the offsets or the record headers
+def load_store_lengths(out_path, meta):
+    if os.path.exists(out_path + "_lengths.npy"):
+        return np.load(out_path + "_lengths.npy")
+    if meta.get('format', 'padded') == 'packed':
+        return np.diff(np.load(out_path + "_offsets.npy")).astype(np.int16)
+    payload_size = 4 + meta['embedding_size'] * np.dtype(meta['type']).itemsize
+    headers = np.memmap(out_path, dtype=np.uint8, mode='r').reshape(-1, payload_size)[:meta['total_number'], :4]
+    return np.ascontiguousarray(headers).view('>i4').reshape(-1).astype(np.int16)
+
+# keep only the records at the sorted positions keep, moving them to the front of the store chunk by chunk,
+# every chunk is read before it is written and keep[k] >= k, so no record is overwritten before it is moved
+# return the new offsets of a packed store
+def compact_store(out_path, keep, packed, dtype, payload_size=None, offsets=None, chunk_records=65536):
+    if not packed:
+        store = np.memmap(out_path, dtype=np.uint8, mode='r+').reshape(-1, payload_size)
+        for start in range(0, len(keep), chunk_records):
+            end = min(start + chunk_records, len(keep))
+            store[start:end] = store[keep[start:end]]
+        store.flush()
+        del store
+        with open(out_path, 'r+b') as f:
+            f.truncate(len(keep) * payload_size)
+        return None
+    lengths = np.diff(offsets)[keep]
+    new_offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+    tokens = np.memmap(out_path, dtype=dtype, mode='r+')
+    for start in range(0, len(keep), chunk_records):
+        end = min(start + chunk_records, len(keep))
+        # token positions of the chunk: each record's old start plus its position within the record
+        chunk_lengths = lengths[start:end]
+        within = np.arange(new_offsets[end] - new_offsets[start]) - np.repeat(new_offsets[start:end] - new_offsets[start], chunk_lengths)
+        tokens[new_offsets[start]:new_offsets[end]] = tokens[np.repeat(offsets[keep[start:end]], chunk_lengths) + within]
+    tokens.flush()
+    del tokens
+    with open(out_path, 'r+b') as f:
+        f.truncate(int(new_offsets[-1]) * np.dtype(dtype).itemsize)
+    return new_offsets
+
+# fall back to path + ".gz" when only the compressed download is on disk
+def get_input_path(path):
+    if not os.path.exists(path) and os.path.exists(path + ".gz"):
+        return path + ".gz"
+    return path
+
+def get_fingerprint(path):
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+# manifest.json: {store name: fingerprints of the input files it was built from}
+def load_manifest(args):
+    manifest_path = os.path.join(args.out_data_dir, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(args, manifest):
+    with open(os.path.join(args.out_data_dir, "manifest.json"), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+# tokenize in_path into the store out_path, keep_ids filters records by raw id
+# dedup: store records with identical tokens once, the ids of the dropped copies become aliases of the first one
+# return IdMap {raw id: offset}
+def build_store(args, in_path, out_path, max_length, line_fn, id_fn, keep_ids=None, dedup=False):
+    packed = args.store_format == "packed"
+    ids, lengths, digests, token_digests = multi_file_process(args, args.num_process, in_path, out_path, line_fn, id_fn, max_length, packed, keep_ids)
+    for idx in range(min(3, len(ids))):
+        print(str(idx) + " " + str(ids[idx]))
+    print("Total lines written: " + str(len(ids)))
+    offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+
+    # data proprecessig meta info
+    meta = {'type': args.token_dtype, 'total_number': len(ids), 'embedding_size': max_length, 'format': args.store_format}
+    alias_ids, alias_offsets = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if dedup:
+        _, first, inverse = np.unique(token_digests, return_index=True, return_inverse=True)
+        keep = np.sort(first)
+        record_offsets = np.searchsorted(keep, first)[inverse.reshape(-1)] # offset of the canonical copy of every record
+        is_alias = first[inverse.reshape(-1)] != np.arange(len(ids))
+        alias_ids, alias_offsets = ids[is_alias], record_offsets[is_alias]
+        if len(keep) < len(ids):
+            new_offsets = compact_store(out_path, keep, packed, args.token_dtype, 4 + max_length * np.dtype(args.token_dtype).itemsize, offsets)
+            offsets = new_offsets if packed else None
+            ids, lengths, digests = ids[keep], lengths[keep], digests[keep]
+        print("Collapsed {} duplicate records, {} unique records left".format(len(alias_ids), len(ids)))
+        IdMap.from_arrays(alias_ids, alias_offsets).save(out_path + "_alias")
+        meta['total_number'] = len(ids)
+        meta['dedup'] = True
+    if packed:
+        meta['pad_token_id'] = load_tokenizer(args).pad_token_id
+        np.save(out_path + "_offsets.npy", offsets)
+    save_store_lengths(out_path, meta, lengths)
+    save_store_meta(out_path, meta)
+
+    save_store_index(out_path, ids, digests)
+    return IdMap.from_arrays(np.concatenate([ids, alias_ids]), np.concatenate([np.arange(len(ids)), alias_offsets]))
+
+# --append: tokenize only the lines of in_path that are new or changed since out_path was built,
+# new records are appended and changed ones replaced in place, the other records are not rewritten
+# return the updated IdMap {raw id: offset}
+def append_store(args, in_path, out_path, max_length, line_fn, id_fn, keep_ids=None):
+    if not os.path.exists(out_path + "_digest.npy"):
+        raise ValueError("{} has no line digests, rebuild it once without --append".format(out_path))
+    ids = np.load(out_path + "_ids.npy")
+    digests = np.load(out_path + "_digest.npy")
+    id_map = IdMap.from_arrays(ids, np.arange(len(ids)))
+    meta = load_store_meta(out_path)
+    if meta['embedding_size'] != max_length:
+        raise ValueError("{} was built with max length {}, got {}".format(out_path, meta['embedding_size'], max_length))
+    packed = meta.get('format', 'padded') == 'packed'
+    if meta.get('dedup', False):
+        raise ValueError("{} was deduplicated, rebuild it without --append".format(out_path))
+    if meta['type'] != args.token_dtype:
+        raise ValueError("{} stores {} tokens, got {}".format(out_path, meta['type'], args.token_dtype))
+
+    delta_count, changed_count = 0, 0
+    delta_path = out_path + "_delta.tsv"
+    with open(delta_path, 'w', encoding='utf-8') as delta_f:
+        for line in read_shard_lines(0, 1, in_path):
+            record_id = id_fn(args, line)
+            if keep_ids is not None and record_id not in keep_ids:
+                continue
+            digest = line_digest(line)
+            offset = id_map.get(record_id)
+            if offset is not None:
+                if digests[offset] == digest:
+                    continue
+                changed_count += 1
+            delta_count += 1
+            delta_f.write(line.rstrip('\r\n') + '\n')
+    print("{}: {} new and {} changed lines".format(out_path, delta_count - changed_count, changed_count))
+    if delta_count == 0:
+        os.remove(delta_path)
+        return id_map
+    if changed_count > 0 and packed:
+        os.remove(delta_path)
+        raise ValueError("changed records cannot be replaced in the packed store {}, rebuild it without --append".format(out_path))
+
+    total_number = meta['total_number']
+    offsets = np.load(out_path + "_offsets.npy") if packed else None
+    lengths = load_store_lengths(out_path, meta)
+    new_ids, new_lengths, new_digests, _ = multi_file_process(args, args.num_process, delta_path, out_path, line_fn, id_fn, max_length, packed,
+                                                              base=(total_number, int(offsets[-1]) if packed else 0))
+    os.remove(delta_path)
+
+    # changed records were written after the existing ones as well, move them back to their own slot
+    old_offsets = id_map.lookup(new_ids)
+    is_changed = old_offsets >= 0
+    if is_changed.any():
+        payload_size = 4 + max_length * np.dtype(meta['type']).itemsize
+        store = np.memmap(out_path, dtype=np.uint8, mode='r+').reshape(-1, payload_size)
+        tail = total_number + np.arange(len(new_ids))
+        store[old_offsets[is_changed]] = store[tail[is_changed]]
+        store[total_number:total_number + int((~is_changed).sum())] = store[tail[~is_changed]]
+        store.flush()
+        del store
+        with open(out_path, 'r+b') as f:
+            f.truncate((total_number + int((~is_changed).sum())) * payload_size)
+        digests[old_offsets[is_changed]] = new_digests[is_changed]
+        lengths[old_offsets[is_changed]] = new_lengths[is_changed]
+    new_ids, new_lengths, new_digests = new_ids[~is_changed], new_lengths[~is_changed], new_digests[~is_changed]
+
+    meta['total_number'] = total_number + len(new_ids)
+    if packed:
+        np.save(out_path + "_offsets.npy", np.concatenate([offsets, offsets[-1] + np.cumsum(new_lengths, dtype=np.int64)]))
+    save_store_lengths(out_path, meta, np.concatenate([lengths, new_lengths]))
+    save_store_meta(out_path, meta)
+    print("Total lines: " + str(meta['total_number']))
+
+    ids = np.concatenate([ids, new_ids])
+    save_store_index(out_path, ids, np.concatenate([digests, new_digests]))
+    return IdMap.from_arrays(ids, np.arange(len(ids)))
+
+# process each line from file
+# transfer each line to "p_id.to_bytes(8, 'big') + passage_len.to_bytes(4, 'big') + content=np.array(input_id_b, np.int32).tobytes()"
+def PassagePreprocessingFn(args, line, tokenizer):
+    p_id, full_text = get_passage_text(args, line, tokenizer.sep_token)
+    # tokenizer.encode: using vocab.txt from BERT change token to dict_id, and add 101=[cls] and 102=[sep] in the before and after passage
+    passage = tokenizer.encode(full_text, add_special_tokens=True, max_length=args.max_seq_length,) # return token id
+    return pack_record(p_id, passage, args.max_seq_length, tokenizer.pad_token_id, args.token_dtype)
+
+# process each line from file
+def QueryPreprocessingFn(args, line, tokenizer):
+    q_id, q_text = get_query_text(args, line)
     passage = tokenizer.encode(q_text, add_special_tokens=True, max_length=args.max_query_length)
-    passage_len = min(len(passage), args.max_query_length)
-    # expand passage with max length by using tokenizer.pad_token_id
-    input_id_b = pad_input_ids(passage, args.max_query_length, pad_token=tokenizer.pad_token_id)
+    return pack_record(q_id, passage, args.max_query_length, tokenizer.pad_token_id, args.token_dtype)
+
+# batched counterparts of PassagePreprocessingFn/QueryPreprocessingFn for --tokenizer_engine fast,
+# lines: a list of raw lines, tokenizer: FastBatchEncoder, returns the concatenated records
+def PassageBatchPreprocessingFn(args, lines, tokenizer):
+    ids, texts = zip(*[get_passage_text(args, line, tokenizer.sep_token) for line in lines])
+    passages = tokenizer.encode_batch(list(texts), args.max_seq_length)
+    return b''.join(pack_record(p_id, passage, args.max_seq_length, tokenizer.pad_token_id, args.token_dtype) for p_id, passage in zip(ids, passages))
 
-    return q_id.to_bytes(8, 'big') + passage_len.to_bytes(4, 'big') + np.array(input_id_b, np.int32).tobytes()
+def QueryBatchPreprocessingFn(args, lines, tokenizer):
+    ids, texts = zip(*[get_query_text(args, line) for line in lines])
+    passages = tokenizer.encode_batch(list(texts), args.max_query_length)
+    return b''.join(pack_record(q_id, passage, args.max_query_length, tokenizer.pad_token_id, args.token_dtype) for q_id, passage in zip(ids, passages))
 
-def write_passage_doc(args, in_passage_path, out_passage_path, PassagePreprocessingFn):
+def write_passage_doc(args, in_passage_path, out_passage_path, PassagePreprocessingFn, manifest):
     '''
         passage: out_passage_path
         passage_len.to_bytes(4, 'big') + content=np.array(input_id_b, np.int32).tobytes()
     '''
-    print('start passage file split processing') 
-    multi_file_process(args, 32, in_passage_path, out_passage_path, PassagePreprocessingFn) # 32 is the number of processing
-
-    print('start merging splits')
-    # read each record by bytes then use int.from_bytes to recover integer number
-    pid2offset = {}
-    out_line_count = 0
-    with open(out_passage_path, 'wb') as f:
-        # transfer each line to "p_id.to_bytes(8, 'big') + passage_len.to_bytes(4, 'big') + content=np.array(input_id_b, np.int32).tobytes()"
-        for idx, record in enumerate(numbered_byte_file_generator(out_passage_path, 32, 8 + 4 + args.max_seq_length * 4)):
-            p_id = int.from_bytes(record[:8], 'big') # p_id: 8 bytes encoder
-            f.write(record[8:]) # saved by bytes
-            pid2offset[p_id] = idx
-            if idx < 3:
-                print(str(idx) + " " + str(p_id))
-            out_line_count += 1
-    print("Total lines written: " + str(out_line_count))
-    
-    # data proprecessig meta info
-    meta = {'type': 'int32', 'total_number': out_line_count, 'embedding_size': args.max_seq_length}
-    with open(out_passage_path + "_meta", 'w') as f:
-        json.dump(meta, f)
+    fingerprint = {'input': get_fingerprint(in_passage_path)}
+    if args.append and os.path.exists(out_passage_path):
+        if manifest.get("passages") == fingerprint:
+            print("passages are up to date")
+            return load_store_id_map(out_passage_path)
+        print('start passage file delta processing')
+        pid2offset = append_store(args, in_passage_path, out_passage_path, args.max_seq_length, PassagePreprocessingFn, get_passage_id)
+    else:
+        print('start passage file split processing')
+        pid2offset = build_store(args, in_passage_path, out_passage_path, args.max_seq_length, PassagePreprocessingFn, get_passage_id, dedup=args.dedup)
+    manifest["passages"] = fingerprint
+    save_manifest(args, manifest)
 
-    # data pid2offset info
-    pid2offset_path = os.path.join(args.out_data_dir, "pid2offset.pickle",)
-    with open(pid2offset_path, 'wb') as handle:
-        pickle.dump(pid2offset, handle, protocol=4) # save dictionary in pickle, {p_id:idx} p_id is the id of document, idx is the index
+    # data pid2offset info, {p_id:idx} p_id is the id of document, idx is the index
+    # with --dedup duplicate passages share the idx of their canonical copy
+    pid2offset.save(os.path.join(args.out_data_dir, "pid2offset"))
     print("done saving pid2offset")
 
     return pid2offset
 
-def write_query_rel(args, pid2offset, query_file, positive_id_file, out_query_file, out_id_file, QueryPreprocessingFn):
+def write_query_rel(args, pid2offset, query_file, positive_id_file, out_query_file, out_id_file, QueryPreprocessingFn, manifest):
     print("Writing query files " + str(out_query_file) + " and " + str(out_id_file))
     query_positive_id = set()
-    query_positive_id_path = os.path.join(args.data_dir, positive_id_file,)
+    query_positive_id_path = get_input_path(os.path.join(args.data_dir, positive_id_file,))
     print("Loading query_to_positive_doc_id")
-    with gzip.open(query_positive_id_path, 'rt', encoding='utf8') if positive_id_file[-2:] == "gz" else open(query_positive_id_path, 'r', encoding='utf8') as f:
-        if args.data_type == 0:
-            tsvreader = csv.reader(f, delimiter=" ")
-        else:
-            tsvreader = csv.reader(f, delimiter="\t")
-        for [topicid, _, docid, rel] in tsvreader:
-            query_positive_id.add(int(topicid))
+    if args.data_type == 0:
+        tsvreader = csv.reader(read_input_lines(query_positive_id_path), delimiter=" ")
+    else:
+        tsvreader = csv.reader(read_input_lines(query_positive_id_path), delimiter="\t")
+    for [topicid, _, docid, rel] in tsvreader:
+        query_positive_id.add(int(topicid))
     '''
         query: out_query_file
         passage_len.to_bytes(4, 'big') + np.array(input_id_b, np.int32).tobytes()
     '''
-    query_collection_path = os.path.join(args.data_dir, query_file,) 
+    query_collection_path = get_input_path(os.path.join(args.data_dir, query_file,))
     out_query_path = os.path.join(args.out_data_dir, out_query_file,)
 
-    qid2offset = {}
-    print('start query file split processing')
-    multi_file_process(args, 32, query_collection_path, out_query_path, QueryPreprocessingFn)
-    
-    print('start merging splits')
-    idx = 0
-    with open(out_query_path, 'wb') as f:
-        # transfer each line to "p_id.to_bytes(8, 'big') + passage_len.to_bytes(4, 'big') + content=np.array(input_id_b, np.int32).tobytes()"
-        for record in numbered_byte_file_generator(out_query_path, 32, 8 + 4 + args.max_query_length * 4):
-            q_id = int.from_bytes(record[:8], 'big')
-            ####
-            if q_id not in query_positive_id: # query_positive_id is a set 
-                # exclude the query as it is not in label set
-                continue
-            ####
-            # ******************exclude q_id, only save q_len, q_content************
-            f.write(record[8:]) 
-            qid2offset[q_id] = idx
-            idx += 1
-            if idx < 3:
-                print(str(idx) + " " + str(q_id))
+    # exclude the queries which are not in label set
+    # the qrels decide which queries are kept, so they are part of the fingerprint
+    fingerprint = {'input': get_fingerprint(query_collection_path), 'qrels': get_fingerprint(query_positive_id_path)}
+    if args.append and os.path.exists(out_query_path):
+        if manifest.get(out_query_file) == fingerprint:
+            print(out_query_file + " is up to date")
+            qid2offset = load_store_id_map(out_query_path)
+        else:
+            print('start query file delta processing')
+            qid2offset = append_store(args, query_collection_path, out_query_path, args.max_query_length, QueryPreprocessingFn, get_query_id, query_positive_id)
+    else:
+        print('start query file split processing')
+        qid2offset = build_store(args, query_collection_path, out_query_path, args.max_query_length, QueryPreprocessingFn, get_query_id, query_positive_id)
+    manifest[out_query_file] = fingerprint
+    save_manifest(args, manifest)
     
     # qid2offset info
-    qid2offset_path = os.path.join(args.out_data_dir, "qid2offset.pickle",)
-    with open(qid2offset_path, 'wb') as handle:
-        pickle.dump(qid2offset, handle, protocol=4)
+    qid2offset.save(os.path.join(args.out_data_dir, "qid2offset"))
     print("done saving qid2offset")
     
-    # query info
-    print("Total lines written: " + str(idx))
-    meta = {'type': 'int32', 'total_number': idx, 'embedding_size': args.max_query_length}
-    with open(out_query_path + "_meta", 'w') as f:
-        json.dump(meta, f)
-    
     '''
         positive id (relevant): out_id_file
         str(qid2offset[topicid]) + "\t" + str(pid2offset[docid]) + "\t" + rel + "\n"
     '''
+    # qrels are always rewritten from the raw file, this does not involve tokenization
     out_id_path = os.path.join(args.out_data_dir, out_id_file,)
     print("Writing qrels")
     # write down: str(qid2offset[topicid]) + "\t" + str(pid2offset[docid]) + "\t" + rel + "\n"
-    with gzip.open(query_positive_id_path, 'rt', encoding='utf8') if positive_id_file[-2:] == "gz" else open(query_positive_id_path, 'r', encoding='utf8') as f, \
-            open(out_id_path, "w", encoding='utf-8') as out_id:
+    with open(out_id_path, "w", encoding='utf-8') as out_id:
         if args.data_type == 0:
-            tsvreader = csv.reader(f, delimiter=" ")
+            tsvreader = csv.reader(read_input_lines(query_positive_id_path), delimiter=" ")
         else:
-            tsvreader = csv.reader(f, delimiter="\t")
+            tsvreader = csv.reader(read_input_lines(query_positive_id_path), delimiter="\t")
         out_line_count = 0
 
         for [topicid, _, docid, rel] in tsvreader:
@@ -233,18 +677,33 @@ def preprocess(args):
     '''
         passage
     '''
-    # input dataset path
+    # input dataset path, msmarco-docs.tsv.gz etc. are streamed without unpacking them first
     if args.data_type == 0:
-        in_passage_path = os.path.join(args.data_dir, "msmarco-docs.tsv",) # MSMARCO/doc
+        in_passage_path = get_input_path(os.path.join(args.data_dir, "msmarco-docs.tsv",)) # MSMARCO/doc
     else: 
-        in_passage_path = os.path.join(args.data_dir, "collection.tsv",) # MSMARCO/passage
+        in_passage_path = get_input_path(os.path.join(args.data_dir, "collection.tsv",)) # MSMARCO/passage
     # output dataset path
     out_passage_path = os.path.join(args.out_data_dir, "passages",) # raw_data/ann_data_tokenizer_seqlen/passages
-    if os.path.exists(out_passage_path): # out_passage_path is file not dir
-        print("preprocessed data already exist, exit preprocessing")
+    if os.path.exists(out_passage_path) and not args.append: # out_passage_path is file not dir
+        print("preprocessed data already exist, exit preprocessing (use --append to process new or changed lines only)")
         return
+    manifest = load_manifest(args)
+    if os.path.exists(out_passage_path):
+        # appended records must match the token dtype of the existing stores
+        args.token_dtype = load_store_meta(out_passage_path)['type']
+    elif args.token_dtype == "auto":
+        # RoBERTa's 50,265 ids fit in uint16, which halves the stores
+        args.token_dtype = "uint16" if len(load_tokenizer(args)) <= np.iinfo(np.uint16).max + 1 else "int32"
+    print("token dtype: " + args.token_dtype)
+
+    if args.tokenizer_engine == "fast":
+        passage_fn, query_fn = PassageBatchPreprocessingFn, QueryBatchPreprocessingFn
+    else:
+        passage_fn, query_fn = PassagePreprocessingFn, QueryPreprocessingFn
 
-    pid2offset = write_passage_doc(args, in_passage_path, out_passage_path, PassagePreprocessingFn)
+    pid2offset = write_passage_doc(args, in_passage_path, out_passage_path, passage_fn, manifest)
+    # training positives are read from the store, the dev qrels keep deduplicated passages apart for evaluation
+    pid2eval_id = load_store_id_map(out_passage_path, eval_ids=True)
     
     '''
         query
@@ -252,12 +711,12 @@ def preprocess(args):
     # start processing
     # pid2offset, query_file, positive_id_file, out_query_file, out_id_file
     if args.data_type == 0:
-        write_query_rel(args, pid2offset, "msmarco-doctrain-queries.tsv", "msmarco-doctrain-qrels.tsv", "train-query", "train-qrel.tsv", QueryPreprocessingFn)
-        write_query_rel(args, pid2offset, "msmarco-test2019-queries.tsv", "2019qrels-docs.txt", "dev-query", "dev-qrel.tsv", QueryPreprocessingFn)
+        write_query_rel(args, pid2offset, "msmarco-doctrain-queries.tsv", "msmarco-doctrain-qrels.tsv", "train-query", "train-qrel.tsv", query_fn, manifest)
+        write_query_rel(args, pid2eval_id, "msmarco-test2019-queries.tsv", "2019qrels-docs.txt", "dev-query", "dev-qrel.tsv", query_fn, manifest)
     else:
         # train-qrel.tsv saves "query index and relevant passage index"
-        write_query_rel(args, pid2offset, "queries.train.tsv", "qrels.train.tsv", "train-query", "train-qrel.tsv", QueryPreprocessingFn)
-        write_query_rel(args, pid2offset, "queries.dev.small.tsv", "qrels.dev.small.tsv", "dev-query", "dev-qrel.tsv", QueryPreprocessingFn)
+        write_query_rel(args, pid2offset, "queries.train.tsv", "qrels.train.tsv", "train-query", "train-qrel.tsv", query_fn, manifest)
+        write_query_rel(args, pid2eval_id, "queries.dev.small.tsv", "qrels.dev.small.tsv", "dev-query", "dev-qrel.tsv", query_fn, manifest)
 
     '''
         remove *_split* files
@@ -277,6 +736,14 @@ def main():
     parser.add_argument("--max_query_length", default=64, type=int, help="The maximum total input sequence length after tokenization. Sequences longer ""than this will be truncated, sequences shorter will be padded.",)
     parser.add_argument("--max_doc_character", default=10000, type=int, help="used before tokenizer to save tokenizer latency",)
     parser.add_argument("--data_type", default=1, type=int, help="0 for doc, 1 for passage",)
+    parser.add_argument("--num_process", default=32, type=int, help="The number of tokenization worker processes",)
+    parser.add_argument("--append", default=False, action="store_true", help="Only tokenize lines that are new or changed since the last run and extend the existing preprocessed data",)
+    parser.add_argument("--store_format", default="padded", type=str, choices=["padded", "packed"], help="padded: fixed-size records padded to max length, written in place by the workers (.gz inputs: through split files), packed: flat token array plus offsets, padded on the fly by EmbeddingCache, always tokenized into split files first and copied into the store",)
+    parser.add_argument("--dedup", default=False, action="store_true", help="Store passages with identical tokens once, pid2offset maps every duplicate pid to the offset of the kept copy, the dev qrels keep the duplicates apart and evaluation ranks them after the kept copy",)
+    parser.add_argument("--token_dtype", default="auto", type=str, choices=["auto", "uint16", "int32"], help="dtype of the stored token ids, auto: uint16 if the tokenizer vocab fits in it",)
+    parser.add_argument("--tokenizer_engine", default="slow", type=str, choices=["slow", "fast"], help="slow: python tokenizer.encode line by line, fast: batched encoding with the Rust tokenizers library",)
+    parser.add_argument("--tokenize_batch_size", default=1000, type=int, help="Number of lines per encode_batch call for --tokenizer_engine fast",)
+    parser.add_argument("--shard_mode", default="byte", type=str, choices=["byte", "line"], help="byte: each worker reads its own line-aligned byte range, line: each worker scans the whole file and keeps every num_process-th line",)
     args = parser.parse_args()
 
     preprocess(args)
@@ -3,41 +3,119 @@ sys.path += ['./']
 import os
 import argparse
 import json
+import threading
+import collections
+import queue
 import numpy as np
 import torch
 import torch.distributed as dist
 
 from models import MSMarcoConfigDict, ALL_MODELS
-from torch.utils.data import TensorDataset, IterableDataset
+from torch.utils.data import IterableDataset, get_worker_info
 
+# records are read with os.pread at their own offset, there is no shared file position, so one cache can be used
+# from several threads, and forked or unpickled DataLoader workers open their own descriptor on first use
+# mmap=True maps the store with np.memmap instead of reading per record, records of a padded store are then
+# views into the mapping and the page cache is shared by every process reading the same file
+# cache_bytes > 0 keeps recently read records in an LRU cache of that many bytes, see stats()
+# readahead_records > 0 makes an unshuffled __iter__ read blocks of that many records in a background thread
 class EmbeddingCache:
-    def __init__(self, base_path, seed=-1):
+    def __init__(self, base_path, seed=-1, mmap=False, cache_bytes=0, readahead_records=0):
         self.base_path = base_path
+        self.mmap = mmap
+        self.readahead_records = readahead_records
+        self.cache_bytes = cache_bytes
+        self.cache = collections.OrderedDict() # key -> (passage_len, passage), least recently used first
+        self.cache_used = 0
+        self.cache_lock = threading.Lock()
+        self.hits, self.misses, self.evictions = 0, 0, 0
         with open(base_path + '_meta', 'r') as f:
             meta = json.load(f)
             self.dtype = np.dtype(meta['type']) # "int32"
             self.total_number = meta['total_number']
+            self.embedding_size = int(meta['embedding_size'])
             # the size of single record: passage_len, passage, stored by bytes
-            self.record_size = int(meta['embedding_size']) * self.dtype.itemsize + 4 # dtype.itemsize = 4
+            self.record_size = self.embedding_size * self.dtype.itemsize + 4 # dtype.itemsize = 4
+            self.record_dtype = np.dtype([('len', '>i4'), ('ids', self.dtype, (self.embedding_size,))])
+            # packed store: flat token array, record k is tokens[offsets[k]:offsets[k + 1]], padded on the fly
+            self.packed = meta.get('format', 'padded') == 'packed'
+            if self.packed:
+                self.pad_token_id = meta['pad_token_id']
+                self.offsets = np.load(base_path + '_offsets.npy')
+        # token count of every record and {length: number of records}, read without touching the token payload,
+        # None for stores preprocessed before the lengths sidecar existed
+        self.lengths = np.load(base_path + '_lengths.npy', mmap_mode='r') if os.path.exists(base_path + '_lengths.npy') else None
+        self.length_histogram = meta.get('length_histogram')
         
+        self.shuffled = seed >= 0
         if seed >= 0:
             self.ix_array = np.random.RandomState(seed).permutation(self.total_number) # generate random list shuffle([i for i in range(total_number)])
         else:
             self.ix_array = np.arange(self.total_number)
-        self.f = None
+        self.is_open = False
+        self.fd = None
+        self.pid = None # process that opened fd
+        self.records = None # mmap mode, padded store: one structured (len, ids) row per record
+        self.tokens = None # mmap mode, packed store: the flat token array
 
     def open(self):
-        self.f = open(self.base_path, 'rb')
+        if not self.mmap:
+            self.fd = os.open(self.base_path, os.O_RDONLY)
+            self.pid = os.getpid()
+        elif self.packed:
+            self.tokens = np.memmap(self.base_path, dtype=self.dtype, mode='r')
+        else:
+            self.records = np.memmap(self.base_path, dtype=self.record_dtype, mode='r', shape=(self.total_number,))
+        self.is_open = True
 
     def close(self):
-        self.f.close()
+        if self.fd is not None and self.pid == os.getpid():
+            os.close(self.fd)
+        self.fd, self.pid = None, None
+        self.records, self.tokens = None, None
+        self.is_open = False
+
+    # the descriptor and the mapping are not sent to spawned workers, they reopen the store instead,
+    # and every worker starts with its own empty record cache
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(fd=None, pid=None, records=None, tokens=None, cache=None, cache_used=0, cache_lock=None, hits=0, misses=0, evictions=0)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = collections.OrderedDict()
+        self.cache_lock = threading.Lock()
+        if self.is_open:
+            self.open()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+                'records': len(self.cache), 'bytes': self.cache_used}
+
+    def read(self, offset, size):
+        if self.pid != os.getpid():
+            # first read after a fork: do not share the parent's descriptor
+            self.open()
+        return os.pread(self.fd, size, offset)
 
-    def read_single_record(self):
-        record_bytes = self.f.read(self.record_size) # read record_size bytes
+    def read_single_record(self, key):
+        record_bytes = self.read(key * self.record_size, self.record_size) # read record_size bytes
         passage_len = int.from_bytes(record_bytes[:4], 'big')
         passage = np.frombuffer(record_bytes[4:], dtype=self.dtype)
         return passage_len, passage
 
+    def read_packed_record(self, key):
+        start, end = self.offsets[key], self.offsets[key + 1]
+        if self.mmap:
+            tokens = self.tokens[start:end]
+        else:
+            tokens = np.frombuffer(self.read(int(start) * self.dtype.itemsize, int(end - start) * self.dtype.itemsize), dtype=self.dtype)
+        passage = np.full(self.embedding_size, self.pad_token_id, dtype=self.dtype)
+        passage[:len(tokens)] = tokens
+        return len(tokens), passage
+
     def __enter__(self):
         self.open()
         return self
@@ -48,118 +126,477 @@ class EmbeddingCache:
     def __getitem__(self, key):
         if key < 0 or key > self.total_number:
             raise IndexError("Index {} is out of bound for cached embeddings of size {}".format(key, self.total_number))
-        self.f.seek(key * self.record_size) # offset
-        return self.read_single_record()
+        if self.cache_bytes <= 0:
+            return self.read_record(key)
+        with self.cache_lock:
+            record = self.cache.get(key)
+            if record is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return record
+            self.misses += 1
+        passage_len, passage = self.read_record(key)
+        # cached arrays are shared by every caller, so they must not be modified
+        passage = np.array(passage)
+        passage.flags.writeable = False
+        with self.cache_lock:
+            if key not in self.cache:
+                self.cache[key] = (passage_len, passage)
+                self.cache_used += passage.nbytes
+                while self.cache_used > self.cache_bytes and self.cache:
+                    _, (_, evicted) = self.cache.popitem(last=False)
+                    self.cache_used -= evicted.nbytes
+                    self.evictions += 1
+        return passage_len, passage
 
-    def __iter__(self):
-        self.f.seek(0)
-        for i in range(self.total_number):
+    def read_record(self, key):
+        if self.packed:
+            return self.read_packed_record(key)
+        if self.mmap:
+            record = self.records[key]
+            return int(record['len']), record['ids']
+        return self.read_single_record(key)
+
+    # tokens [B, embedding_size] and lengths [B] of the records at indices
+    def get_batch(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.mmap and not self.packed and self.cache_bytes <= 0:
+            # a single gather over the mapping
+            records = self.records[indices]
+            return records['ids'], records['len'].astype(np.int32)
+        if self.mmap and self.cache_bytes <= 0:
+            lengths = (self.offsets[indices + 1] - self.offsets[indices]).astype(np.int32)
+            within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            return self.pad_tokens(self.tokens[np.repeat(self.offsets[indices], lengths) + within], lengths), lengths
+        records = [self[int(key)] for key in indices]
+        return np.stack([passage for _, passage in records]), np.array([passage_len for passage_len, _ in records], dtype=np.int32)
+
+    # scatter the concatenated tokens of len(lengths) packed records into a padded [B, embedding_size] matrix
+    def pad_tokens(self, flat_tokens, lengths):
+        tokens = np.full((len(lengths), self.embedding_size), self.pad_token_id, dtype=self.dtype)
+        # position of every token within its record
+        within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        tokens[np.repeat(np.arange(len(lengths)), lengths), within] = flat_tokens
+        return tokens
+
+    # lengths and padded tokens of the records start ... end - 1 with one contiguous read
+    def read_block(self, start, end):
+        if self.packed:
+            token_start, token_end = int(self.offsets[start]), int(self.offsets[end])
+            if self.mmap:
+                flat_tokens = np.array(self.tokens[token_start:token_end])
+            else:
+                flat_tokens = np.frombuffer(self.read(token_start * self.dtype.itemsize, (token_end - token_start) * self.dtype.itemsize), dtype=self.dtype)
+            lengths = np.diff(self.offsets[start:end + 1]).astype(np.int32)
+            return lengths, self.pad_tokens(flat_tokens, lengths)
+        if self.mmap:
+            records = np.array(self.records[start:end]) # touching the pages here is the read-ahead
+        else:
+            records = np.frombuffer(self.read(start * self.record_size, (end - start) * self.record_size), dtype=self.record_dtype)
+        return records['len'].astype(np.int32), records['ids']
+
+    # sequential scan: a background thread reads the next blocks into a bounded queue while the caller
+    # consumes the current one, so disk reads overlap with whatever the caller does with the records
+    def iter_readahead(self, start=0, end=None, max_blocks=4):
+        end = self.total_number if end is None else end
+        blocks = queue.Queue(maxsize=max_blocks)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    blocks.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                if not self.mmap and hasattr(os, 'posix_fadvise'):
+                    self.read(0, 0) # make sure this process has its descriptor
+                    os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                for block_start in range(start, end, self.readahead_records):
+                    if not put(self.read_block(block_start, min(block_start + self.readahead_records, end))):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(None)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                block = blocks.get()
+                if block is None:
+                    break
+                if isinstance(block, Exception):
+                    raise block
+                lengths, tokens = block
+                for k in range(len(lengths)):
+                    yield int(lengths[k]), tokens[k]
+        finally:
+            stop.set()
+            producer.join()
+
+    # records at iteration positions start ... end - 1, a DataLoader worker only reads its own range
+    def iter_range(self, start, end):
+        if self.readahead_records > 0 and not self.shuffled:
+            # records come straight from the blocks, a front to back scan would only churn the LRU cache
+            yield from self.iter_readahead(start, end)
+            return
+        for i in range(start, end):
             new_ix = self.ix_array[i]
             yield self.__getitem__(new_ix)
 
+    def __iter__(self):
+        return self.iter_range(0, self.total_number)
+
     def __len__(self):
         return self.total_number
 
+# the dataset fns below yield raw (passage_len, passage) records, the collate fns turn a whole batch into tensors
 def GetProcessingFn(args, query=False):
     def fn(vals, i): # i: id
         passage_len, passage = vals
-        max_len = args.max_query_length if query else args.max_seq_length
-        """
-        Args:
-            input_ids: Indices of input sequence tokens in the vocabulary.
-            attention_mask: Mask to avoid performing attention on padding token indices.
-                Mask values selected in ``[0, 1]``:
-                Usually  ``1`` for tokens that are NOT MASKED, ``0`` for MASKED (padded) tokens.
-            token_type_ids: Segment token indices to indicate first and second portions of the inputs.
-            label: Label corresponding to the input
-        """
-        pad_len = max(0, max_len - passage_len)
-        token_type_ids = ([0] if query else [1]) * passage_len + [0] * pad_len
-        attention_mask = [1] * passage_len + [0] * pad_len
-        # id, passage_each_token_id, [1,1,1, ..., 0,0,0], [0,0,0, ..., 0,0,0]/[1,1,1, ..., 0,0,0]
-        passage_collection = [(i, passage, attention_mask, token_type_ids)] 
-
-        # change input into torch.tensor format
-        query2id_tensor = torch.tensor([f[0] for f in passage_collection], dtype=torch.long) # [id]
-        all_input_ids_a = torch.tensor([f[1] for f in passage_collection], dtype=torch.int) # [passage_each_token_id]
-        all_attention_mask_a = torch.tensor([f[2] for f in passage_collection], dtype=torch.bool) # [1,1,1, ..., 0,0,0]
-        all_token_type_ids_a = torch.tensor([f[3] for f in passage_collection], dtype=torch.uint8) # [0,0,0, ..., 0,0,0]/[1,1,1, ..., 0,0,0]
-        # passage_each_token_id, [1,1,1, ..., 0,0,0], [0,0,0, ..., 0,0,0]/[1,1,1, ..., 0,0,0], id
-        # zip a, b, c, d, https://blog.csdn.net/qq_40211493/article/details/107529148
-        dataset = TensorDataset(all_input_ids_a, all_attention_mask_a, all_token_type_ids_a, query2id_tensor) # like zip
-
-        return [ts for ts in dataset] # [[a,b,c,d]]
+        return [(passage_len, passage, i)]
 
     return fn
 
-# read from ann file to get query id, pos_id, neg_id which is index in the dataset
+# rows of the ann data (utils/ann_data.py) give query id, pos_id, neg_ids which are indices in the dataset
 def GetTrainingDataProcessingFn(args, query_cache, passage_cache):
-    def fn(line, i):
-        line_arr = line.split('\t')
-        
-        qid = int(line_arr[0])
-        pos_pid = int(line_arr[1])
-        neg_pids = line_arr[2].split(',')
-        neg_pids = [int(neg_pid) for neg_pid in neg_pids]
-
-        # all_input_ids_a = []
-        # all_attention_mask_a = []
+    def fn(row, i):
+        qid = int(row['qid'])
+        pos_pid = int(row['pos'])
+        neg_pids = [int(neg_pid) for neg_pid in row['neg'] if neg_pid >= 0] # -1 pads queries with fewer negatives
 
-        query_data = GetProcessingFn(args, query=True)(query_cache[qid], qid)[0]
-        pos_data = GetProcessingFn(args, query=False)(passage_cache[pos_pid], pos_pid)[0]
+        query_data = query_cache[qid]
+        # positive and negatives in one gather
+        tokens, lengths = passage_cache.get_batch([pos_pid] + neg_pids)
+        pos_data = (int(lengths[0]), tokens[0])
 
-        pos_label = torch.tensor(1, dtype=torch.long)
-        neg_label = torch.tensor(0, dtype=torch.long)
-
-        for neg_pid in neg_pids:
-            neg_data = GetProcessingFn(args, query=False)(passage_cache[neg_pid], neg_pid)[0]
-            yield (query_data[0], query_data[1], query_data[2], pos_data[0], pos_data[1], pos_data[2], pos_label)
-            yield (query_data[0], query_data[1], query_data[2], neg_data[0], neg_data[1], neg_data[2], neg_label)
+        for k in range(1, len(lengths)):
+            neg_data = (int(lengths[k]), tokens[k])
+            yield (query_data, pos_data, 1)
+            yield (query_data, neg_data, 0)
 
     return fn
 
 def GetTripletTrainingDataProcessingFn(args, query_cache, passage_cache):
     # query_cache: [(len, [id1, id2, id3, ....., 1, 1, 1, 1]), ...]
     # passage_cache: [(len, [id1, id2, id3, ....., 1, 1, 1, 1]), ...]
-    def fn(line, i): # ann data: for i, line in enumerate(ann_data.readlines())
-        line_arr = line.split('\t')
+    def fn(row, i): # ann data: for i, row in enumerate(load_ann_data(ann_path))
         # qid, pos_pid, neg_pids (token index in the dataset)
-        # f.write("{}\t{}\t{}\n".format(query_id, pos_pid, ','.join(str(neg_pid) for neg_pid in query_negative_passage[query_id])))
-        qid = int(line_arr[0])
-        pos_pid = int(line_arr[1])
-        neg_pids = line_arr[2].split(',')
-        neg_pids = [int(neg_pid) for neg_pid in neg_pids]
-
-        # all_input_ids_a = []
-        # all_attention_mask_a = []
-        
+        qid = int(row['qid'])
+        pos_pid = int(row['pos'])
+        neg_pids = [int(neg_pid) for neg_pid in row['neg'] if neg_pid >= 0] # -1 pads queries with fewer negatives
+
         # qid, pos_pid, neg_pids are the index from preprocessed dataset
-        query_data = GetProcessingFn(args, query=True)(query_cache[qid], qid)[0] # [a,b,c,d]
-        pos_data = GetProcessingFn(args, query=False)(passage_cache[pos_pid], pos_pid)[0] # [a,b,c,d]
-        for neg_pid in neg_pids:
-            neg_data = GetProcessingFn(args, query=False)(passage_cache[neg_pid], neg_pid)[0]
-            yield (query_data[0], query_data[1], query_data[2], pos_data[0], pos_data[1], pos_data[2],
-                   neg_data[0], neg_data[1], neg_data[2]) # qid, pos_pid, and neg_pid are not needed. 
+        query_data = query_cache[qid] # (passage_len, passage)
+        # positive and negatives in one gather
+        tokens, lengths = passage_cache.get_batch([pos_pid] + neg_pids)
+        pos_data = (int(lengths[0]), tokens[0])
+        for k in range(1, len(lengths)):
+            yield (query_data, pos_data, (int(lengths[k]), tokens[k])) # qid, pos_pid, and neg_pid are not needed.
+
+    return fn
+
+# batches are padded to the longest real sequence rounded up to a multiple, never past the stored width,
+# MaxP passages to whole chunks of the model's base_len, pad_to_multiple_of <= 0 keeps the full stored width
+def get_pad_multiple(args, query=False):
+    base_len = getattr(MSMarcoConfigDict[args.model_type].model_class, 'base_len', None)
+    if not query and base_len is not None:
+        return base_len if args.pad_to_multiple_of > 0 else 0
+    return args.pad_to_multiple_of
+
+def padded_length(max_len, full_length, pad_to_multiple_of):
+    if pad_to_multiple_of <= 0:
+        return full_length
+    max_len = max(int(max_len), 1)
+    return min(-(-max_len // pad_to_multiple_of) * pad_to_multiple_of, full_length)
+
+# one (query, pos, [neg_1, ..., neg_k]) group per ann data row, the query and positive are encoded once for all negatives
+def GetGroupedTrainingDataProcessingFn(args, query_cache, passage_cache):
+    def fn(row, i):
+        qid = int(row['qid'])
+        pos_pid = int(row['pos'])
+        neg_pids = [int(neg_pid) for neg_pid in row['neg'] if neg_pid >= 0] # -1 pads queries with fewer negatives
+
+        query_data = query_cache[qid]
+        tokens, lengths = passage_cache.get_batch([pos_pid] + neg_pids)
+        yield (query_data, (int(lengths[0]), tokens[0]), [(int(lengths[k]), tokens[k]) for k in range(1, len(lengths))])
+
+    return fn
+
+# input_ids and attention_mask [B, padded_length] of a list of (passage_len, passage) records, each built with one allocation,
+# token_type_ids ([1] * passage_len for passages, all 0 for queries) only if the model asks for them
+def collate_records(records, query=False, with_token_type_ids=False, pad_to_multiple_of=0):
+    lengths = np.array([passage_len for passage_len, _ in records], dtype=np.int64)
+    seq_length = padded_length(lengths.max(), len(records[0][1]), pad_to_multiple_of)
+    input_ids = np.empty((len(records), seq_length), dtype=np.int64)
+    for k, (_, passage) in enumerate(records):
+        input_ids[k] = passage[:seq_length] # also up-casts uint16 stores
+    attention_mask = np.arange(input_ids.shape[1]) < lengths[:, None]
+    tensors = [torch.from_numpy(input_ids), torch.from_numpy(attention_mask.astype(np.int64))]
+    if with_token_type_ids:
+        tensors.append(torch.zeros_like(tensors[1]) if query else tensors[1].clone())
+    return tensors
+
+# --pack_length > 0 concatenates several records into one row of at most pack_length tokens (first fit, a longer record
+# gets a row of its own): input_ids [R, L] (pad_token_id after the records), segment_ids [R, L] (k for the tokens of the k-th record of the row, 0 for
+# padding), segment_positions [R, L] (position of every token inside its record) and cls_index [N, 2] (row and column of
+# the first token of each record, in record order); the model builds the block-diagonal attention mask from segment_ids
+def pack_records(records, pack_length, pad_token_id, pad_to_multiple_of=0):
+    row_fill, placement = [], [] # tokens used per row, (row, start) per record
+    for passage_len, _ in records:
+        passage_len = int(passage_len)
+        row = next((r for r, fill in enumerate(row_fill) if fill + passage_len <= pack_length), len(row_fill))
+        if row == len(row_fill):
+            row_fill.append(0)
+        placement.append((row, row_fill[row]))
+        row_fill[row] += passage_len
+    seq_length = padded_length(max(row_fill), max(max(row_fill), pack_length), pad_to_multiple_of)
+    input_ids = np.full((len(row_fill), seq_length), pad_token_id, dtype=np.int64)
+    segment_ids = np.zeros((len(row_fill), seq_length), dtype=np.int64)
+    segment_positions = np.zeros((len(row_fill), seq_length), dtype=np.int64)
+    segments_in_row = [0] * len(row_fill)
+    for (passage_len, passage), (row, start) in zip(records, placement):
+        passage_len = int(passage_len)
+        segments_in_row[row] += 1
+        input_ids[row, start:start + passage_len] = passage[:passage_len]
+        segment_ids[row, start:start + passage_len] = segments_in_row[row]
+        segment_positions[row, start:start + passage_len] = np.arange(passage_len)
+    cls_index = np.array(placement, dtype=np.int64).reshape(-1, 2)
+    return [torch.from_numpy(input_ids), torch.from_numpy(segment_ids), torch.from_numpy(segment_positions), torch.from_numpy(cls_index)]
+
+# records -> [input_ids, attention_mask (segment_ids when packing), extras...] where the extras are token_type_ids,
+# or segment_positions and cls_index when packing
+def GetRecordsCollateFn(args, query=False, with_token_type_ids=False):
+    pad_multiple = get_pad_multiple(args, query)
+    if args.pack_length > 0:
+        return lambda records: pack_records(records, args.pack_length, args.pad_token_id, pad_multiple)
+    return lambda records: collate_records(records, query, with_token_type_ids, pad_multiple)
+
+# inference batch: input_ids, attention_mask, id [, token_type_ids], packed: input_ids, segment_ids, id, segment_positions, cls_index
+def GetInferenceCollateFn(args, query=False, with_token_type_ids=False):
+    collate = GetRecordsCollateFn(args, query, with_token_type_ids)
+    def collate_fn(batch):
+        input_ids, attention_mask, *extras = collate([(passage_len, passage) for passage_len, passage, _ in batch])
+        ids = torch.tensor([i for _, _, i in batch], dtype=torch.long)
+        return tuple([input_ids, attention_mask, ids] + extras)
+
+    return collate_fn
+
+# triplet batch: query, positive and negative input_ids and attention_mask [, their token_type_ids or packing extras]
+def GetTripletCollateFn(args, with_token_type_ids=False):
+    collate_query, collate_passage = GetRecordsCollateFn(args, True, with_token_type_ids), GetRecordsCollateFn(args, False, with_token_type_ids)
+    def collate_fn(batch):
+        query = collate_query([sample[0] for sample in batch])
+        pos = collate_passage([sample[1] for sample in batch])
+        neg = collate_passage([sample[2] for sample in batch])
+        return tuple(query[:2] + pos[:2] + neg[:2] + query[2:] + pos[2:] + neg[2:])
+
+    return collate_fn
+
+# pairwise batch: query and passage input_ids and attention_mask, label [, their token_type_ids]
+def GetPairwiseCollateFn(args, with_token_type_ids=False):
+    query_multiple, passage_multiple = get_pad_multiple(args, True), get_pad_multiple(args, False)
+    def collate_fn(batch):
+        query = collate_records([sample[0] for sample in batch], True, with_token_type_ids, query_multiple)
+        passage = collate_records([sample[1] for sample in batch], False, with_token_type_ids, passage_multiple)
+        labels = torch.tensor([sample[2] for sample in batch], dtype=torch.long)
+        return tuple(query[:2] + passage[:2] + [labels] + query[2:] + passage[2:])
+
+    return collate_fn
+
+# grouped batch: query and positive input_ids and attention_mask [B, L], negatives [B * k, L] with the k negatives of
+# each query in a row, neg_mask [B, k] (0 for the slots of queries with fewer than k negatives) [, token_type_ids or packing extras]
+def GetGroupedCollateFn(args, with_token_type_ids=False):
+    collate_query, collate_passage = GetRecordsCollateFn(args, True, with_token_type_ids), GetRecordsCollateFn(args, False, with_token_type_ids)
+    def collate_fn(batch):
+        num_neg = max(max(len(sample[2]) for sample in batch), 1)
+        neg_mask = torch.zeros((len(batch), num_neg), dtype=torch.long)
+        negs = []
+        for k, sample in enumerate(batch):
+            neg_mask[k, :len(sample[2])] = 1
+            # free slots repeat a record of this group, their logits are masked out by the loss
+            filler = sample[2][0] if len(sample[2]) > 0 else sample[1]
+            negs += sample[2] + [filler] * (num_neg - len(sample[2]))
+        query = collate_query([sample[0] for sample in batch])
+        pos = collate_passage([sample[1] for sample in batch])
+        neg = collate_passage(negs)
+        return tuple(query[:2] + pos[:2] + neg[:2] + [neg_mask] + query[2:] + pos[2:] + neg[2:])
+
+    return collate_fn
+
+# record lengths of each part of a training sample: query, positive and negative records, or the list of negative
+# records of a grouped sample, the positive when it has none (GetGroupedCollateFn fills its slots with it); labels are skipped
+def sample_token_shape(sample):
+    shape = []
+    for part in sample:
+        if isinstance(part, list):
+            shape.append([int(passage_len) for passage_len, _ in part] or shape[-1][:1])
+        elif isinstance(part, tuple):
+            shape.append([int(part[0])])
+    return shape
+
+# first-fit rows of pack_records after appending records of the given lengths to rows filled with row_fill tokens
+def pack_row_fill(row_fill, lengths, pack_length):
+    row_fill = list(row_fill)
+    for passage_len in lengths:
+        row = next((r for r, fill in enumerate(row_fill) if fill + passage_len <= pack_length), len(row_fill))
+        if row == len(row_fill):
+            row_fill.append(0)
+        row_fill[row] += passage_len
+    return row_fill
+
+# size of one part of a batch as the collate fn builds it: fn(state, lengths) adds the record lengths of one more sample
+# (state None for the first) and returns (state, tokens); padded records take one row per record (grouped negatives:
+# the most records of a sample, see GetGroupedCollateFn) of the longest record rounded like padded_length, packed
+# records the first-fit rows of pack_records rounded the same way
+def GetPartTokensFn(args, query=False):
+    pad_multiple = get_pad_multiple(args, query)
+    full_length = args.max_query_length if query else args.max_seq_length
+    if args.pack_length > 0:
+        def fn(state, lengths):
+            samples, count, row_fill = state if state is not None else ([], 1, [])
+            samples = samples + [lengths]
+            with_fillers = lambda sample: sample + sample[:1] * (count - len(sample))
+            if len(lengths) > count: # more filler negatives in every earlier sample, pack the batch again
+                count = len(lengths)
+                row_fill = pack_row_fill([], [passage_len for sample in samples for passage_len in with_fillers(sample)], args.pack_length)
+            else:
+                row_fill = pack_row_fill(row_fill, with_fillers(lengths), args.pack_length)
+            if not row_fill:
+                return (samples, count, row_fill), 0
+            return (samples, count, row_fill), len(row_fill) * padded_length(max(row_fill), max(max(row_fill), args.pack_length), pad_multiple)
+        return fn
+    def fn(state, lengths):
+        samples, count, longest = state if state is not None else (0, 1, 0)
+        state = (samples + 1, max(count, len(lengths)), max([longest] + lengths))
+        return state, state[0] * state[1] * padded_length(state[2], full_length, pad_multiple)
+    return fn
+
+# GetPartTokensFn of the query and passage parts of a training sample
+def GetSampleTokensFns(args):
+    return [GetPartTokensFn(args, True), GetPartTokensFn(args, False), GetPartTokensFn(args, False)]
+
+# groups items into batches whose collated size, summed over the parts of shape_fn(item), stays within max_tokens,
+# an item over the budget on its own gets a batch of its own
+def iter_token_budget(items, shape_fn, part_tokens_fns, max_tokens):
+    batch, states = [], None
+    for item in items:
+        shape = shape_fn(item)
+        if batch:
+            merged = [fn(state, lengths) for fn, state, lengths in zip(part_tokens_fns, states, shape)]
+            if sum(tokens for _, tokens in merged) > max_tokens:
+                yield batch
+                batch = []
+        if not batch:
+            merged = [fn(None, lengths) for fn, lengths in zip(part_tokens_fns, shape)]
+        batch.append(item)
+        states = [state for state, _ in merged]
+    if batch:
+        yield batch
+
+# training samples in batches of at most args.max_tokens collated query + passage tokens, padding included,
+# yields whole batches: use with batch_size=None
+class TokenBudgetBatchDataset(IterableDataset):
+    def __init__(self, dataset, args):
+        super().__init__()
+        self.dataset = dataset
+        self.max_tokens = args.max_tokens
+        self.part_tokens_fns = GetSampleTokensFns(args)
+
+    def __iter__(self):
+        return iter_token_budget(self.dataset, sample_token_shape, self.part_tokens_fns, self.max_tokens)
+
+# token counts of the records at ids, from the lengths sidecar when the store has one
+def record_lengths(cache, ids):
+    ids = np.asarray(ids, dtype=np.int64)
+    if cache.lengths is not None:
+        return np.asarray(cache.lengths[ids], dtype=np.int64)
+    return np.array([cache[int(key)][0] for key in ids], dtype=np.int64)
+
+# number of batches the training dataset of each rank yields for the ann data rows: train_batch_size batches of the
+# samples of every DataLoader worker, or token-budget batches computed from the record lengths only; the largest count
+# over the ranks, so every rank builds the same scheduler
+def count_training_batches(args, rows, query_cache, passage_cache, num_replicas=1):
+    if args.max_tokens > 0:
+        count_fn = GetTokenBudgetCountFn(args, rows, query_cache, passage_cache)
+    else:
+        neg_count = (rows['neg'] >= 0).sum(axis=1)
+        # samples per row: one group, one triplet per negative, or a positive and a negative pair per negative
+        samples = np.ones(len(rows), dtype=np.int64) if args.group_negatives else (neg_count if args.triplet else 2 * neg_count)
+        count_fn = lambda start, end: -(-int(samples[start:end].sum()) // args.train_batch_size)
+    num_workers = max(args.num_workers, 1)
+    counts = []
+    for rank in range(num_replicas):
+        count = 0
+        for worker_id in range(num_workers):
+            count += count_fn(*shard_range(len(rows), rank * num_workers + worker_id, num_replicas * num_workers))
+        counts.append(count)
+    return max(counts)
+
+# fn(start, end): number of token-budget batches of the samples of rows start ... end - 1
+def GetTokenBudgetCountFn(args, rows, query_cache, passage_cache):
+    query_len = record_lengths(query_cache, rows['qid'])
+    pos_len = record_lengths(passage_cache, rows['pos'])
+    neg_len = record_lengths(passage_cache, np.maximum(rows['neg'], 0).reshape(-1)).reshape(rows['neg'].shape)
+    def row_shapes(k): # the sample_token_shape of every sample the processing fn yields for row k
+        negs = [int(neg_len[k, j]) for j in range(rows['neg'].shape[1]) if rows['neg'][k, j] >= 0]
+        query, pos = [int(query_len[k])], [int(pos_len[k])]
+        if args.group_negatives:
+            return [[query, pos, negs or pos]]
+        if args.triplet:
+            return [[query, pos, [neg]] for neg in negs]
+        return [shape for neg in negs for shape in ([query, pos], [query, [neg]])]
+    part_tokens_fns = GetSampleTokensFns(args)
+    def fn(start, end):
+        shapes = (shape for k in range(start, end) for shape in row_shapes(k))
+        return sum(1 for _ in iter_token_budget(shapes, lambda shape: shape, part_tokens_fns, args.max_tokens))
 
     return fn
 
+# indices of the shard-th of num_shards contiguous ranges of range(length)
+def shard_range(length, shard, num_shards):
+    return length * shard // num_shards, length * (shard + 1) // num_shards
+
+# element i goes to rank i % world_size, and within a rank to DataLoader worker (i // world_size) % num_workers, so no
+# element is yielded twice; the order is deterministic for a given world size, num_workers and batch size
+# numpy elements (memory-mapped ann data) and EmbeddingCache stores are split into contiguous index ranges instead,
+# rank first, then worker, so each process only reads its own part of the file, in the order it was written
 class StreamingDataset(IterableDataset):
     def __init__(self, elements, fn, distributed=True):
         super().__init__()
-        self.elements = elements  # elements: ann_data_file -> f.readlines()
+        self.elements = elements  # elements: ann data rows, store records or lines
         self.fn = fn
         self.num_replicas=-1 
         self.distributed = distributed
-    
-    def __iter__(self):
+        # read in the main process, DataLoader workers get a copy
         if dist.is_initialized():
             self.num_replicas = dist.get_world_size()
             self.rank = dist.get_rank()
-        else:
+    
+    def __iter__(self):
+        if self.num_replicas == -1:
             print("Not running in distributed mode")
+        num_replicas, rank = (self.num_replicas, self.rank) if self.distributed and self.num_replicas != -1 else (1, 0)
+        worker_info = get_worker_info()
+        num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info is not None else (1, 0)
+        if isinstance(self.elements, (np.ndarray, EmbeddingCache)):
+            start, end = shard_range(len(self.elements), rank * num_workers + worker_id, num_replicas * num_workers)
+            if isinstance(self.elements, EmbeddingCache):
+                elements = self.elements.iter_range(start, end)
+            else:
+                elements = (self.elements[i] for i in range(start, end))
+            for i, element in zip(range(start, end), elements):
+                yield from self.fn(element, i)
+            return
             
         for i, element in enumerate(self.elements):
-            if self.distributed and self.num_replicas != -1 and i % self.num_replicas != self.rank:
+            if i % num_replicas != rank or (i // num_replicas) % num_workers != worker_id:
                 continue
             # (query: all_input_ids_a, all_attention_mask_a, all_token_type_ids_a
             # positive: all_input_ids_a, all_attention_mask_a, all_token_type_ids_a
@@ -168,6 +605,29 @@ class StreamingDataset(IterableDataset):
             for rec in records:
                 yield rec
 
+# groups the (passage_len, passage, id) records of a stream into batches of similar length to cut padding, records are
+# buffered window at a time so the store is still read front to back, yields whole batches: use with batch_size=None
+class LengthBucketedDataset(IterableDataset):
+    def __init__(self, dataset, batch_size, window=4096):
+        super().__init__()
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.window = max(-(-window // batch_size), 1) * batch_size # whole batches per window
+
+    def bucket(self, records):
+        records.sort(key=lambda rec: rec[0]) # stable, equal lengths keep their stream order
+        for start in range(0, len(records), self.batch_size):
+            yield records[start:start + self.batch_size]
+
+    def __iter__(self):
+        records = []
+        for rec in self.dataset:
+            records.append(rec)
+            if len(records) == self.window:
+                yield from self.bucket(records)
+                records = []
+        yield from self.bucket(records)
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--data_dir", default="./data/MSMARCO", type=str, help="The input data dir",)
@@ -9,12 +9,15 @@ import faiss
 import os
 import pytrec_eval
 import json
+import itertools
 from tqdm import tqdm 
 from utils.msmarco_eval import compute_metrics
 from utils.util import convert_to_string_id
+from utils.id_map import load_id_map, load_alias_expansion, expand_aliases
 
 # query id [all_data_num, 1], passage id, positive id ({query_id: {passage_id:rel, ...}, ...}), retrieval topk id
-def EvalDevQuery(dev_query_embedding2id, passage_embedding2id, dev_query_positive_id, I_nearest_neighbor, topN):
+# alias_expansion: {passage id: evaluation ids of its duplicates} of a deduplicated store, see load_alias_expansion
+def EvalDevQuery(dev_query_embedding2id, passage_embedding2id, dev_query_positive_id, I_nearest_neighbor, topN, alias_expansion):
     prediction = {} #[qid][docid] = docscore, here we use -rank as score, so the higher the rank (1 > 2), the higher the score (-1 > -2)
     total = 0
     labeled = 0 # 
@@ -34,8 +37,8 @@ def EvalDevQuery(dev_query_embedding2id, passage_embedding2id, dev_query_positiv
             # By default, all PIDs in the list of 1000 are 0. Only override those that are given
             tmp = [0] * 1000
             qids_to_ranked_candidate_passages[query_id] = tmp       
-        for idx in selected_ann_idx:
-            pred_pid = passage_embedding2id[idx] # get passage index
+        # the duplicates of a deduplicated store follow their kept copy, as many candidates as without dedup
+        for pred_pid in itertools.islice(expand_aliases([passage_embedding2id[idx] for idx in selected_ann_idx], alias_expansion), len(selected_ann_idx)):
             if not pred_pid in seen_pid:
                 # this check handles multiple vector per document
                 qids_to_ranked_candidate_passages[query_id][rank]=pred_pid
@@ -89,7 +92,7 @@ def EvalDevQuery(dev_query_embedding2id, passage_embedding2id, dev_query_positiv
 
     return final_ndcg, eval_query_cnt, final_Map, final_mrr, final_recall, hole_rate, ms_mrr, Ahole_rate, result, prediction
 
-def barrier_array_merge(args)
+def barrier_array_merge(args):
     dev_query_embedding = []
     dev_query_embedding2id = []
     passage_embedding = []
@@ -116,14 +119,10 @@ def barrier_array_merge(args)
     
     return dev_query_embedding, dev_query_embedding2id, passage_embedding, passage_embedding2id
 
-def prepare_rerank_data(args, raw_data_dir)
-    qidmap_path = args.processed_data_dir + "/qid2offset.pickle" # {real_query_id: query_id, ...}
-    pidmap_path = args.processed_data_dir + "/pid2offset.pickle" # {real_passage_id: passage_id, ...}
-    # qidmap and pidmap: {raw_id: dataset_id, ...}
-    with open(qidmap_path, 'rb') as handle:
-        qidmap = pickle.load(handle)
-    with open(pidmap_path, 'rb') as handle:
-        pidmap = pickle.load(handle)
+def prepare_rerank_data(args, raw_data_dir):
+    # qidmap and pidmap: {raw_id: dataset_id, ...} as memory mapped IdMap
+    qidmap = load_id_map(args.processed_data_dir, "qid2offset") # {real_query_id: query_id, ...}
+    pidmap = load_id_map(args.processed_data_dir, "pid2offset") # {real_passage_id: passage_id, ...}
 
     # query data and passage data from raw data
     if args.data_type == 0:
@@ -140,6 +139,8 @@ def prepare_rerank_data(args, raw_data_dir)
         else:
             query_path = os.path.join(raw_data_dir, "passage/queries.dev.small.tsv") # qrels.dev.small.tsv
             passage_path = os.path.join(raw_data_dir, "passage/top1000.dev")
+    # files downloaded with --keep_compressed are still .gz
+    query_path, passage_path = [path + ".gz" if not os.path.exists(path) and os.path.exists(path + ".gz") else path for path in (query_path, passage_path)]
 
     bm25 = collections.defaultdict(set) # [(key, value[set]), ...]
     # load query data and get query id set: practical id 
@@ -149,6 +150,7 @@ def prepare_rerank_data(args, raw_data_dir)
         for [qid, query] in tsvreader: # each query data
             qset.add(qid) # qset = {qid1, qid2, ...}
     # passage data (including qrel data)
+    candidate_qids, candidate_pids = [], []
     with gzip.open(passage_path, 'rt', encoding='utf-8') if passage_path[-2:] == "gz" else open(passage_path, 'rt', encoding='utf-8') as f:
         for line in tqdm(f):
             if args.data_type == 0:
@@ -157,8 +159,15 @@ def prepare_rerank_data(args, raw_data_dir)
             else:
                 [qid, pid, query, passage] = line.split("\t")
             
-            if qid in qset and int(qid) in qidmap: # int(qid) in qidmap means in qidmap.keys()
-                bm25[qidmap[int(qid)]].add(pidmap[int(pid)]) # [(qid_index, {passage_index}), ...]
+            if qid in qset:
+                candidate_qids.append(int(qid))
+                candidate_pids.append(int(pid))
+    # map all candidates to dataset index at once, -1 for ids missing from the map
+    candidate_qids = qidmap.lookup(candidate_qids)
+    candidate_pids = pidmap.lookup(candidate_pids)
+    found = (candidate_qids >= 0) & (candidate_pids >= 0)
+    for qid, pid in zip(candidate_qids[found].tolist(), candidate_pids[found].tolist()):
+        bm25[qid].add(pid) # [(qid_index, {passage_index}), ...]
     print("number of queries with " + str(topN) + " BM25 passages:", len(bm25))
     return bm25
 
@@ -191,6 +200,7 @@ def main():
     topN = 100 if args.data_type == 0 else 1000
 
     dev_query_positive_id = get_dev_query_pos_id(args, args.processed_data_dir) # {topici_id:{docid:rel, ...}, ...} # rel=1
+    alias_expansion = load_alias_expansion(os.path.join(args.processed_data_dir, "passages")) # empty without --dedup
     bm25 = prepare_rerank_data(args, args.raw_data) # bm25:  [(qid_index, {passage_index}), ...]
     dev_query_embedding, dev_query_embedding2id, passage_embedding, passage_embedding2id = barrier_array_merge(args) # [all_data_num, embeddingS], # [all_data_num, 1]
 
@@ -233,7 +243,7 @@ def main():
                 dev_I[0][j] = p_set_map[dev_I[0][j]]
             all_dev_I.append(dev_I[0])
         # pytrec_eval
-        result = EvalDevQuery(dev_query_embedding2id, passage_embedding2id, dev_query_positive_id, all_dev_I, topN) # topN = 100 if args.data_type == 0 else 1000
+        result = EvalDevQuery(dev_query_embedding2id, passage_embedding2id, dev_query_positive_id, all_dev_I, topN, alias_expansion) # topN = 100 if args.data_type == 0 else 1000
         final_ndcg, eval_query_cnt, final_Map, final_mrr, final_recall, hole_rate, ms_mrr, Ahole_rate, metrics, prediction = result
         print("Reranking Results for checkpoint " + str(args.step_num))
         print("Reranking NDCG@10:" + str(final_ndcg))
@@ -253,7 +263,7 @@ def main():
     cpu_index.add(passage_embedding) 
     _, dev_I = cpu_index.search(dev_query_embedding, topN) # topN = 100 if args.data_type == 0 else 1000
     # pytrec_eval
-    result = EvalDevQuery(dev_query_embedding2id, passage_embedding2id, dev_query_positive_id, dev_I, topN)
+    result = EvalDevQuery(dev_query_embedding2id, passage_embedding2id, dev_query_positive_id, dev_I, topN, alias_expansion)
     final_ndcg, eval_query_cnt, final_Map, final_mrr, final_recall, hole_rate, ms_mrr, Ahole_rate, metrics, prediction = result
     print("Results for checkpoint " + str(args.step_num))
     print("NDCG@10:" + str(final_ndcg))
@@ -11,13 +11,16 @@ import time
 import pytrec_eval ##
 import csv
 import copy
+import itertools
 import pickle
 import transformers
 import torch.distributed as dist
 ##
-from dataloader import GetProcessingFn, EmbeddingCache, StreamingDataset
+from dataloader import GetProcessingFn, GetInferenceCollateFn, EmbeddingCache, StreamingDataset, LengthBucketedDataset
 from models import MSMarcoConfigDict, ALL_MODELS
-from utils.util import convert_to_string_id, is_first_worker, get_checkpoint_no, get_latest_ann_data
+from utils.util import convert_to_string_id, is_first_worker, get_checkpoint_no, get_latest_ann_data, order_triplets
+from utils.ann_data import save_ann_data
+from utils.id_map import load_alias_expansion, expand_aliases
 ##
 from transformers import (
     AdamW,
@@ -88,6 +91,8 @@ def GenerateNegativePassaageID(args, query_embedding2id, passage_embedding2id, t
 def EvalDevQuery(args, query_embedding2id, passage_embedding2id, dev_query_positive_id, I_nearest_neighbor):
     # [qid][docid] = docscore, here we use -rank as score, so the higher the rank (1 > 2), the higher the score (-1 > -2)
     prediction = {} # {query_id: {passage_id:rel, ...}, ...}
+    # dev qrels of a deduplicated store hold the evaluation ids of duplicate passages, see load_alias_expansion
+    alias_expansion = load_alias_expansion(os.path.join(args.data_dir, "passages"))
     for query_idx in range(I_nearest_neighbor.shape[0]): # all number data
         query_id = query_embedding2id[query_idx] # 
         prediction[query_id] = {}
@@ -96,8 +101,7 @@ def EvalDevQuery(args, query_embedding2id, passage_embedding2id, dev_query_posit
         selected_ann_idx = top_ann_pid[:50] # topk=50 results passage index
         rank = 0
         seen_pid = set()
-        for idx in selected_ann_idx:
-            pred_pid = passage_embedding2id[idx]
+        for pred_pid in itertools.islice(expand_aliases([passage_embedding2id[idx] for idx in selected_ann_idx], alias_expansion), len(selected_ann_idx)):
             if pred_pid not in seen_pid:
                 # this check handles multiple vector per document
                 rank += 1
@@ -176,12 +180,14 @@ def InferenceEmbeddingFromStreamDataLoader(args, model, train_dataloader, is_que
     model.eval()
 
     for batch in tqdm(train_dataloader, desc="Inferencing", disable=args.local_rank not in [-1, 0], position=0, leave=True):
-        # batch: all_input_ids_a, all_attention_mask_a, all_token_type_ids_a, query2id_tensor [index of dataset]
-        idxs = batch[3].detach().numpy()  # [#B]
+        # batch: all_input_ids_a, all_attention_mask_a, query2id_tensor [index of dataset]
+        idxs = batch[2].detach().numpy()  # [#B]
         batch = tuple(t.to(args.device) for t in batch)
 
         with torch.no_grad():
-            inputs = {"input_ids": batch[0].long(), "attention_mask": batch[1].long()}
+            inputs = {"input_ids": batch[0], "attention_mask": batch[1]}
+            if args.pack_length > 0: # batch[1] holds segment_ids, see pack_records
+                inputs.update({"segment_positions": batch[3], "cls_index": batch[4]})
             if is_query_inference:
                 embs = model.module.query_emb(**inputs) # query1 = self.norm(self.embeddingHead(full_emb)) # linear layer, following layerNorm
             else:
@@ -199,13 +205,24 @@ def InferenceEmbeddingFromStreamDataLoader(args, model, train_dataloader, is_que
 
     embedding = np.concatenate(embedding, axis=0) # [all_data_num, embeddingS]
     embedding2id = np.concatenate(embedding2id, axis=0)
+    if args.length_bucket_window > 0 or args.num_workers > 0:
+        # batches were bucketed by length or interleaved from workers, restore the store order of this rank's records
+        order = np.argsort(embedding2id, kind="stable")
+        embedding, embedding2id = embedding[order], embedding2id[order]
     return embedding, embedding2id # [all_data_num, embeddingS], # [all_data_num, 1]
 
 # streaming inference
 def StreamInferenceDoc(args, model, fn, prefix, f, is_query_inference=True): # f: input data
     inference_batch_size = args.per_gpu_eval_batch_size  # * max(1, args.n_gpu)
-    inference_dataset = StreamingDataset(f, fn) # fn: passage_each_token_id, [1,1,1, ..., 0,0,0], [0,0,0, ..., 0,0,0]/[1,1,1, ..., 0,0,0], id
-    inference_dataloader = DataLoader(inference_dataset, batch_size=inference_batch_size) # single input, not Triplet
+    inference_dataset = StreamingDataset(f, fn) # fn: (passage_len, passage, id)
+    # collate: passage_each_token_id, [1,1,1, ..., 0,0,0], id
+    collate_fn = GetInferenceCollateFn(args, query=is_query_inference)
+    if args.length_bucket_window > 0:
+        # the dataset yields whole batches of similar length
+        inference_dataset = LengthBucketedDataset(inference_dataset, inference_batch_size, args.length_bucket_window)
+        inference_dataloader = DataLoader(inference_dataset, batch_size=None, collate_fn=collate_fn, num_workers=args.num_workers)
+    else:
+        inference_dataloader = DataLoader(inference_dataset, batch_size=inference_batch_size, collate_fn=collate_fn, num_workers=args.num_workers) # single input, not Triplet
 
     if args.local_rank != -1:
         dist.barrier()  # directory created
@@ -239,6 +256,7 @@ def load_model(args, checkpoint_path):
                                                           do_lower_case=True,
                                                           cache_dir=None,
     )
+    args.pad_token_id = tokenizer.pad_token_id # fills packed rows, see pack_records
     model = configObj.model_class.from_pretrained(args.model_name_or_path,
                                                   from_tf=bool(".ckpt" in args.model_name_or_path),
                                                   config=config,
@@ -259,7 +277,7 @@ def generate_new_ann(args, output_num, checkpoint_path, training_query_positive_
     #==============================================================================================
     logger.info("***** inference of dev query *****")
     dev_query_collection_path = os.path.join(args.data_dir, "dev-query") # preprocessed data path
-    dev_query_cache = EmbeddingCache(dev_query_collection_path) # passage_len, passage
+    dev_query_cache = EmbeddingCache(dev_query_collection_path, mmap=args.mmap_cache, readahead_records=args.readahead_records) # passage_len, passage
     with dev_query_cache as emb:
         # [all_data_num, embeddingS]
         dev_query_embedding, dev_query_embedding2id = StreamInferenceDoc(args, model, 
@@ -269,7 +287,7 @@ def generate_new_ann(args, output_num, checkpoint_path, training_query_positive_
                                                                          is_query_inference=True)
     logger.info("***** inference of passages *****")
     passage_collection_path = os.path.join(args.data_dir, "passages")
-    passage_cache = EmbeddingCache(passage_collection_path)
+    passage_cache = EmbeddingCache(passage_collection_path, mmap=args.mmap_cache, readahead_records=args.readahead_records)
     with passage_cache as emb:
         passage_embedding, passage_embedding2id = StreamInferenceDoc(args, model, 
                                                                      GetProcessingFn(args, query=False), # passage
@@ -281,7 +299,7 @@ def generate_new_ann(args, output_num, checkpoint_path, training_query_positive_
         return
     logger.info("***** inference of train query *****")
     train_query_collection_path = os.path.join(args.data_dir, "train-query")
-    train_query_cache = EmbeddingCache(train_query_collection_path)
+    train_query_cache = EmbeddingCache(train_query_collection_path, mmap=args.mmap_cache, readahead_records=args.readahead_records)
     with train_query_cache as emb:
         query_embedding, query_embedding2id = StreamInferenceDoc(args, model, 
                                                                  GetProcessingFn(args, query=True), # train query
@@ -336,19 +354,19 @@ def generate_new_ann(args, output_num, checkpoint_path, training_query_positive_
 
         #-------------------------------------------------------new ann data generation--------------------------------------------------------
         logger.info("***** Construct ANN Triplet *****")
-        # ann_dir/ann_training_data_[output_num]-(query_id, pos_pid, neg_pid)
+        # ann_dir/ann_training_data_[output_num].npy-(query_id, pos_pid, neg_pids), see utils/ann_data.py
         # ann_dir/ann_ndcg_[output_num]-({ndcg: dev_ndcg (ndcg results from dev dataset), checkpoint: checkpoint_path (current checkpoint used for generation)})
-        train_data_output_path = os.path.join(args.ann_dir, "ann_training_data_" + str(output_num))
-        with open(train_data_output_path, 'w') as f:
-            query_range = list(range(I.shape[0])) # [0, 1, 2, ..., queries_per_chunk-1]
-            random.shuffle(query_range)
-            for query_idx in query_range:
-                query_id = query_embedding2id[query_idx]
-                # training_query_positive_id: {query_id: passage_id, ...}, query_negative_passage: {query_id: negative_passage_id, ...}
-                if query_id not in effective_q_id or query_id not in training_query_positive_id:
-                    continue
-                pos_pid = training_query_positive_id[query_id]
-                f.write("{}\t{}\t{}\n".format(query_id, pos_pid, ','.join(str(neg_pid) for neg_pid in query_negative_passage[query_id])))
+        train_data_output_path = os.path.join(args.ann_dir, "ann_training_data_" + str(output_num) + ".npy")
+        # training_query_positive_id: {query_id: passage_id, ...}, query_negative_passage: {query_id: negative_passage_id, ...}
+        query_range = [query_idx for query_idx in range(I.shape[0]) # [0, 1, 2, ..., queries_per_chunk-1]
+                       if query_embedding2id[query_idx] in effective_q_id and query_embedding2id[query_idx] in training_query_positive_id]
+        # smallest passage offset each triplet reads, --ann_order locality groups triplets reading nearby records
+        triplet_keys = [min([training_query_positive_id[query_id]] + query_negative_passage[query_id]) for query_id in query_embedding2id[query_range]]
+        query_ids = [query_embedding2id[query_range[k]] for k in order_triplets(triplet_keys, args.ann_order, args.shuffle_window)]
+        save_ann_data(train_data_output_path,
+                      query_ids,
+                      [training_query_positive_id[query_id] for query_id in query_ids],
+                      [query_negative_passage[query_id] for query_id in query_ids])
 
         ndcg_output_path = os.path.join(args.ann_dir, "ann_ndcg_" + str(output_num))
         with open(ndcg_output_path, 'w') as f:
@@ -490,9 +508,19 @@ def main():
     parser.add_argument("--ann_measure_topk_mrr", default=False, action="store_true", help="load scheduler from checkpoint or not",)
     parser.add_argument("--local_rank", type=int, default=-1, help="For distributed training: local_rank",)
     parser.add_argument("--inference", default=False, action="store_true", help="only do inference if specify",)
+    parser.add_argument("--num_workers", default=0, type=int, help="DataLoader workers reading and collating inference batches, each gets its own share of the records",)
+    parser.add_argument("--length_bucket_window", default=4096, type=int, help="Records sorted by length together before they are batched for encoding, 0 to batch in store order",)
+    parser.add_argument("--pack_length", default=0, type=int, help="Pack several records into rows of this many tokens with a block-diagonal attention mask (rdot_nll only), 0 to disable",)
+    parser.add_argument("--pad_to_multiple_of", default=8, type=int, help="Pad each batch to its longest sequence rounded up to this multiple (MaxP passages: to whole 512 chunks), 0 to always pad to the max length",)
+    parser.add_argument("--mmap_cache", default=False, action="store_true", help="Memory map the preprocessed query and passage stores instead of reading them record by record",)
+    parser.add_argument("--ann_order", default="random", type=str, choices=["random", "locality"], help="Order of the written triplets, locality: grouped by the passage offsets they read, shuffled within --shuffle_window",)
+    parser.add_argument("--shuffle_window", default=1024, type=int, help="Number of consecutive triplets shuffled together with --ann_order locality",)
+    parser.add_argument("--readahead_records", default=4096, type=int, help="Records per block read ahead in a background thread while the stores are encoded, 0 to disable",)
     parser.add_argument("--end_output_num", default=-1, type=int, help="Stop after this number of data versions has been generated, default run forever",)
     
     args = parser.parse_args()
+    if args.pack_length > 0 and hasattr(MSMarcoConfigDict[args.model_type].model_class, 'base_len'):
+        raise ValueError("--pack_length is not supported by {}, its passages are split into chunks".format(args.model_type))
     
     # ----------------------------------
     set_env(args)
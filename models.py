@@ -11,6 +11,7 @@ from transformers import (
     # BertConfig
 )
 import torch.nn.functional as F
+import torch.distributed as dist
 
 class EmbeddingMixin:
     """
@@ -50,31 +51,105 @@ class EmbeddingMixin:
     def body_emb(self, input_ids, attention_mask):
         raise NotImplementedError("Please Implement this method")
 
+# concatenation of the [n_rank, ...] tensors of every rank in rank order; the backward sums the gradients of all
+# ranks and hands each rank the rows it contributed, so other ranks' losses train this rank's embeddings too
+class AllGatherWithGrad(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, tensor, sizes):
+        ctx.sizes = sizes
+        padded = torch.zeros((max(sizes),) + tuple(tensor.shape[1:]), dtype=tensor.dtype, device=tensor.device)
+        padded[:tensor.size(0)] = tensor
+        gathered = [torch.empty_like(padded) for _ in sizes]
+        dist.all_gather(gathered, padded)
+        return torch.cat([part[:size] for part, size in zip(gathered, sizes)], dim=0)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_output = grad_output.clone() # autograd may share the incoming buffer, reduce a copy
+        dist.all_reduce(grad_output)
+        start = sum(ctx.sizes[:dist.get_rank()])
+        return grad_output[start:start + ctx.sizes[dist.get_rank()]], None
+
+# -> (rows of every rank, offset of this rank's rows), ranks may have different row counts
+def all_gather_with_grad(tensor):
+    sizes = [torch.zeros(1, dtype=torch.long, device=tensor.device) for _ in range(dist.get_world_size())]
+    dist.all_gather(sizes, torch.tensor([tensor.size(0)], dtype=torch.long, device=tensor.device))
+    sizes = [int(size) for size in sizes]
+    return AllGatherWithGrad.apply(tensor, sizes), sum(sizes[:dist.get_rank()])
+
 ## FirstP
 # (query_data[0], query_data[1], # content, mask
 #  pos_data[0], pos_data[1],
 #  neg_data[0], neg_data[1],) 
+# grouped batches carry k negatives per query: input_ids_b [B * k, L], neg_mask [B, k] (0 for padded slots),
+# the query and positive are encoded once and the loss is a softmax over the positive and all k negatives
+# packed batches (dataloader.pack_records) pass segment_ids as the attention masks plus segment_positions_* and cls_index_*
+# in_batch_negatives "batch" scores every query against all positives and negatives of the batch, "ranks" against
+# those of every DDP rank as well
+# fused_encoder "passages" encodes positives and negatives in one encoder pass, "all" the queries too (see fused_emb)
 class NLL(EmbeddingMixin):
     def forward(self, query_ids, attention_mask_q, 
                       input_ids_a=None, attention_mask_a=None, # positive passage
                       input_ids_b=None, attention_mask_b=None, # negative passage
-                      is_query=True):
+                      is_query=True, neg_mask=None, in_batch_negatives="none", fused_encoder="none",
+                      segment_positions_q=None, cls_index_q=None,
+                      segment_positions_a=None, cls_index_a=None,
+                      segment_positions_b=None, cls_index_b=None):
         if input_ids_b is None and is_query:
-            return self.query_emb(query_ids, attention_mask_q)
+            return self.query_emb(query_ids, attention_mask_q, segment_positions_q, cls_index_q)
         elif input_ids_b is None:
-            return self.body_emb(query_ids, attention_mask_q)
+            return self.body_emb(query_ids, attention_mask_q, segment_positions_q, cls_index_q)
 
         # get the dense representation of query, postive passage, negtive passage
-        q_embs = self.query_emb(query_ids, attention_mask_q)
-        a_embs = self.body_emb(input_ids_a, attention_mask_a)
-        b_embs = self.body_emb(input_ids_b, attention_mask_b)
+        if fused_encoder == "all":
+            q_embs, a_embs, b_embs = self.fused_emb([(query_ids, attention_mask_q), (input_ids_a, attention_mask_a), (input_ids_b, attention_mask_b)])
+        elif fused_encoder == "passages":
+            q_embs = self.query_emb(query_ids, attention_mask_q, segment_positions_q, cls_index_q)
+            a_embs, b_embs = self.fused_emb([(input_ids_a, attention_mask_a), (input_ids_b, attention_mask_b)])
+        else:
+            q_embs = self.query_emb(query_ids, attention_mask_q, segment_positions_q, cls_index_q)
+            a_embs = self.body_emb(input_ids_a, attention_mask_a, segment_positions_a, cls_index_a)
+            b_embs = self.body_emb(input_ids_b, attention_mask_b, segment_positions_b, cls_index_b)
+        if in_batch_negatives != "none":
+            return (self.in_batch_nll(q_embs, a_embs, b_embs, neg_mask, in_batch_negatives == "ranks"),)
 
         # nll loss
-        logit_matrix = torch.cat([(q_embs * a_embs).sum(-1).unsqueeze(1), (q_embs * b_embs).sum(-1).unsqueeze(1)], dim=1)  # [B, 2]
+        batchS = q_embs.size(0)
+        b_embs = b_embs.reshape(batchS, -1, b_embs.size(-1)) # [B, k, embeddingS]
+        logits_b = (q_embs.unsqueeze(1) * b_embs).sum(-1) # [B, k]
+        if neg_mask is not None:
+            logits_b = logits_b + ((1 - neg_mask) * (-9999)).float()
+        logit_matrix = torch.cat([(q_embs * a_embs).sum(-1).unsqueeze(1), logits_b], dim=1)  # [B, 1 + k]
         lsm = F.log_softmax(logit_matrix, dim=1) # apply in the dim=1 
         loss = -1.0 * lsm[:, 0]
         return (loss.mean(),)
 
+    # [(input_ids, attention_mask), ...] -> their embeddings from a single encoder pass: the parts are cut or padded to the
+    # longest real sequence among all of them and stacked; queries and passages share one encoder (body_emb is query_emb)
+    def fused_emb(self, parts):
+        width = max(int(attention_mask.sum(dim=1).max()) for _, attention_mask in parts)
+        pad_token_id = self.roberta.embeddings.padding_idx
+        input_ids = torch.cat([F.pad(ids[:, :width], (0, width - min(ids.size(1), width)), value=pad_token_id) for ids, _ in parts], dim=0)
+        attention_mask = torch.cat([F.pad(mask[:, :width], (0, width - min(mask.size(1), width)), value=0) for _, mask in parts], dim=0)
+        embs = self.body_emb(input_ids, attention_mask)
+        return torch.split(embs, [ids.size(0) for ids, _ in parts], dim=0)
+
+    def in_batch_nll(self, q_embs, a_embs, b_embs, neg_mask=None, cross_rank=False):
+        batchS = q_embs.size(0)
+        # candidates: the positives, query i's is row i, then the negatives, padded slots masked out
+        candidates = torch.cat([a_embs, b_embs], dim=0) # [B + B * k, embeddingS]
+        candidate_mask = torch.ones(candidates.size(0), dtype=torch.float, device=candidates.device)
+        if neg_mask is not None:
+            candidate_mask[batchS:] = neg_mask.reshape(-1).float()
+        offset = 0
+        if cross_rank and dist.is_initialized():
+            candidates, offset = all_gather_with_grad(candidates)
+            candidate_mask, _ = all_gather_with_grad(candidate_mask)
+        logit_matrix = torch.matmul(q_embs, candidates.t()).float() + (1 - candidate_mask).unsqueeze(0) * (-9999) # [B, all candidates]
+        lsm = F.log_softmax(logit_matrix, dim=1)
+        loss = -1.0 * lsm[torch.arange(batchS, device=lsm.device), offset + torch.arange(batchS, device=lsm.device)]
+        return loss.mean()
+
 class RobertaDot_NLL_LN(NLL, RobertaForSequenceClassification):
     """None
     Compress embedding to 200d, then computes NLL loss.
@@ -86,22 +161,34 @@ class RobertaDot_NLL_LN(NLL, RobertaForSequenceClassification):
         self.norm = nn.LayerNorm(768)
         self.apply(self._init_weights) # initialize all layers' parameters weight
 
-    def query_emb(self, input_ids, attention_mask):
+    def query_emb(self, input_ids, attention_mask, segment_positions=None, cls_index=None):
+        if cls_index is not None:
+            return self.packed_emb(input_ids, attention_mask, segment_positions, cls_index)
         # roberta accepts input_ids, and attention_mask for each sequence, i.e., [token_id1, token_id2, ...], [1,1,1, ..., 0,0,0]
         outputs1 = self.roberta(input_ids=input_ids, attention_mask=attention_mask)
         full_emb = self.masked_mean_or_first(outputs1, attention_mask)
         query1 = self.norm(self.embeddingHead(full_emb)) # linear layer, following layerNorm
         return query1
 
-    def body_emb(self, input_ids, attention_mask):
-        return self.query_emb(input_ids, attention_mask)
+    def body_emb(self, input_ids, attention_mask, segment_positions=None, cls_index=None):
+        return self.query_emb(input_ids, attention_mask, segment_positions, cls_index)
+
+    # several sequences per row: segment_ids [R, L] (0 for padding), segment_positions [R, L], cls_index [N, 2]
+    def packed_emb(self, input_ids, segment_ids, segment_positions, cls_index):
+        # block-diagonal mask [R, L, L], a token only attends to the tokens of its own sequence
+        attention_mask = (segment_ids.unsqueeze(2) == segment_ids.unsqueeze(1)) & (segment_ids.unsqueeze(1) > 0)
+        # every sequence restarts at the first roberta position, padding_idx + 1
+        position_ids = segment_positions + self.roberta.embeddings.padding_idx + 1
+        outputs1 = self.roberta(input_ids=input_ids, attention_mask=attention_mask.long(), position_ids=position_ids)
+        full_emb = outputs1[0][cls_index[:, 0], cls_index[:, 1]] # [cls] of every sequence -> [N, dim]
+        return self.norm(self.embeddingHead(full_emb))
 
 ## MaxP
 class NLL_MultiChunk(EmbeddingMixin):
     def forward(self, query_ids, attention_mask_q, 
                       input_ids_a=None, attention_mask_a=None, 
                       input_ids_b=None, attention_mask_b=None, 
-                      is_query=True):
+                      is_query=True, neg_mask=None):
         if input_ids_b is None and is_query:
             return self.query_emb(query_ids, attention_mask_q)
         elif input_ids_b is None:
@@ -109,13 +196,14 @@ class NLL_MultiChunk(EmbeddingMixin):
 
         q_embs = self.query_emb(query_ids, attention_mask_q) # [batchS, embeddingS]
         a_embs = self.body_emb(input_ids_a, attention_mask_a) # [batchS, chunk_factor, embeddingS]
-        b_embs = self.body_emb(input_ids_b, attention_mask_b) # [batchS, chunk_factor, embeddingS]
+        b_embs = self.body_emb(input_ids_b, attention_mask_b) # [batchS * k, chunk_factor, embeddingS], k negatives per query
 
-        [batchS, full_length] = input_ids_a.size()
-        chunk_factor = full_length // self.base_len # the number of chunk
+        batchS = input_ids_a.size(0)
+        # the number of chunk, batches are padded to their own length so positives and negatives may differ
+        chunk_factor_a, chunk_factor_b = a_embs.size(1), b_embs.size(1)
 
         # special handle of attention mask -----[batchS, chunk_factor, base_len] -> [:, :, 0] - > [batchS, chunk_factor]
-        attention_mask_body = attention_mask_a.reshape(batchS, chunk_factor, -1)[:, :, 0]  # [batchS, chunk_factor]
+        attention_mask_body = attention_mask_a.reshape(batchS, chunk_factor_a, -1)[:, :, 0]  # [batchS, chunk_factor]
         inverted_bias = ((1 - attention_mask_body) * (-9999)).float() # [batchS, chunk_factor]
         a12 = torch.matmul(q_embs.unsqueeze(1), a_embs.transpose(1, 2))  # [batch, 1, chunk_factor]
         # using the max pooling to get single score
@@ -123,22 +211,26 @@ class NLL_MultiChunk(EmbeddingMixin):
         # -------------------------------------
 
         # special handle of attention mask -----
-        attention_mask_body = attention_mask_b.reshape(batchS, chunk_factor, -1)[:, :, 0]  # [batchS, chunk_factor]
-        inverted_bias = ((1 - attention_mask_body) * (-9999)).float() # [batchS, chunk_factor]
-        a12 = torch.matmul(q_embs.unsqueeze(1), b_embs.transpose(1, 2))  # [batch, 1, chunk_factor]
+        num_neg = b_embs.size(0) // batchS
+        attention_mask_body = attention_mask_b.reshape(batchS * num_neg, chunk_factor_b, -1)[:, :, 0]  # [batchS * k, chunk_factor]
+        inverted_bias = ((1 - attention_mask_body) * (-9999)).float() # [batchS * k, chunk_factor]
+        a12 = torch.matmul(q_embs.repeat_interleave(num_neg, dim=0).unsqueeze(1), b_embs.transpose(1, 2))  # [batch * k, 1, chunk_factor]
         # using the max pooling to get single score
-        logits_b = (a12[:, 0, :] + inverted_bias).max(dim=-1, keepdim=False).values  # [batch]
+        logits_b = (a12[:, 0, :] + inverted_bias).max(dim=-1, keepdim=False).values.reshape(batchS, num_neg)  # [batch, k]
+        if neg_mask is not None:
+            logits_b = logits_b + ((1 - neg_mask) * (-9999)).float()
         # -------------------------------------
 
-        logit_matrix = torch.cat([logits_a.unsqueeze(1), logits_b.unsqueeze(1)], dim=1)  # [B, 2]
+        logit_matrix = torch.cat([logits_a.unsqueeze(1), logits_b], dim=1)  # [B, 1 + k]
         lsm = F.log_softmax(logit_matrix, dim=1) # apply in the dim=1
         loss = -1.0 * lsm[:, 0]
         return (loss.mean(),)
 
 class RobertaDot_CLF_ANN_NLL_MultiChunk(NLL_MultiChunk, RobertaDot_NLL_LN):
+    base_len = 512 # base length of input, the collate fns pad passage batches to a multiple of it
+
     def __init__(self, config):
         RobertaDot_NLL_LN.__init__(self, config)
-        self.base_len = 512 # base length of input
 
     def body_emb(self, input_ids, attention_mask):
         [batchS, full_length] = input_ids.size()
@@ -9,11 +9,13 @@ logger = logging.getLogger(__name__)
 import random
 import numpy as np
 ##
-from dataloader import GetTrainingDataProcessingFn, GetTripletTrainingDataProcessingFn, EmbeddingCache, StreamingDataset
+from dataloader import GetTrainingDataProcessingFn, GetTripletTrainingDataProcessingFn, GetGroupedTrainingDataProcessingFn, GetTripletCollateFn, GetPairwiseCollateFn, GetGroupedCollateFn, EmbeddingCache, StreamingDataset
+from dataloader import TokenBudgetBatchDataset, count_training_batches
 from models import MSMarcoConfigDict, ALL_MODELS
 
 from utils.util import getattr_recursive, set_seed, get_checkpoint_no, get_latest_ann_data, is_first_worker
 from utils.lamb import Lamb
+from utils.ann_data import load_ann_data
 from utils.eval_mrr import passage_dist_eval
 ##
 from transformers import glue_processors as processors
@@ -34,6 +36,13 @@ try:
 except ImportError:
     from tensorboardX import SummaryWriter
 
+# plain triplets yield one (query, pos, neg) sample per negative, with several negatives per ann row the in-batch
+# candidates would hold copies of a query's own positive as its negatives
+def check_in_batch_negatives(args, ann_training_data):
+    num_neg = ann_training_data['neg'].shape[1]
+    if args.in_batch_negatives != "none" and not args.group_negatives and num_neg > 1:
+        raise ValueError("--in_batch_negatives needs --group_negatives, the ann data has {} negatives per query".format(num_neg))
+
 def train(args, model, tokenizer, query_cache, passage_cache):
     """ Train the model """
     tb_writer = None
@@ -106,6 +115,7 @@ def train(args, model, tokenizer, query_cache, passage_cache):
     step = 0
     global_step = 0
     tr_loss = 0.0
+    step_loss, step_samples = 0.0, 0 # of the current optimizer step
     last_ann_no = -1
     train_dataloader = None
     train_dataloader_iter = None
@@ -140,8 +150,8 @@ def train(args, model, tokenizer, query_cache, passage_cache):
                 ann_checkpoint_path = ndcg_json['checkpoint']
                 ann_checkpoint_no = get_checkpoint_no(ann_checkpoint_path)
                 
-                with open(ann_path, 'r') as f:
-                    ann_training_data = f.readlines()
+                ann_training_data = load_ann_data(ann_path) # memory mapped (qid, pos, neg[k]) rows
+                check_in_batch_negatives(args, ann_training_data)
                 aligned_size = (len(ann_training_data) // args.world_size) * args.world_size
                 ann_training_data = ann_training_data[:aligned_size]
                 logger.info("Total ann queries (after align): %d", len(ann_training_data))
@@ -149,18 +159,32 @@ def train(args, model, tokenizer, query_cache, passage_cache):
                 '''
                     Get training dataload (Important!)
                 '''
-                if args.triplet:
+                if args.group_negatives:
+                    train_dataset = StreamingDataset(ann_training_data, GetGroupedTrainingDataProcessingFn(args, query_cache, passage_cache))
+                    collate_fn = GetGroupedCollateFn(args)
+                elif args.triplet:
                     train_dataset = StreamingDataset(ann_training_data, GetTripletTrainingDataProcessingFn(args, query_cache, passage_cache))
+                    collate_fn = GetTripletCollateFn(args)
                 else:
                     train_dataset = StreamingDataset(ann_training_data, GetTrainingDataProcessingFn(args, query_cache, passage_cache))
-                train_dataloader = DataLoader(train_dataset, batch_size=args.train_batch_size)
+                    collate_fn = GetPairwiseCollateFn(args)
+                if args.max_tokens > 0:
+                    # the dataset yields whole batches filled up to the token budget
+                    train_dataset = TokenBudgetBatchDataset(train_dataset, args)
+                    train_dataloader = DataLoader(train_dataset, batch_size=None, collate_fn=collate_fn, num_workers=args.num_workers)
+                else:
+                    train_dataloader = DataLoader(train_dataset, batch_size=args.train_batch_size, collate_fn=collate_fn, num_workers=args.num_workers)
                 # manually set it as iter which reture generator itself and next to get next batch data
                 train_dataloader_iter = iter(train_dataloader)
                 
                 ###
                 # re-warmup with multiple times
                 if not args.single_warmup:
-                    scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=args.warmup_steps, num_training_steps=len(ann_training_data))
+                    # optimizer steps in one pass over the ann data, with or without a token budget
+                    num_batches = count_training_batches(args, ann_training_data, query_cache, passage_cache, args.world_size)
+                    num_training_steps = max(num_batches // args.gradient_accumulation_steps, 1)
+                    logger.info("Training batches per rank: %d, optimizer steps: %d", num_batches, num_training_steps)
+                    scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=args.warmup_steps, num_training_steps=num_training_steps)
                 if args.local_rank != -1:
                     dist.barrier() # sync load dataset
                 if is_first_worker():
@@ -189,24 +213,31 @@ def train(args, model, tokenizer, query_cache, passage_cache):
             token_type_ids: Segment token indices to indicate first and second portions of the inputs.
             label: Label corresponding to the input
         if triplet:
-            (query_data[0], query_data[1], query_data[2], # content, mask, segment
-             pos_data[0], pos_data[1], pos_data[2],
-             neg_data[0], neg_data[1], neg_data[2]) 
-             # qid, pos_pid, and neg_pid are not needed. 
+            (query content, mask, pos content, mask, neg content, mask) built by GetTripletCollateFn
         else:
-            (query_data[0], query_data[1], query_data[2], pos_data[0], pos_data[1], pos_data[2], pos_label) 
-            or
-            (query_data[0], query_data[1], query_data[2], neg_data[0], neg_data[1], neg_data[2], neg_label)
+            (query content, mask, passage content, mask, pos_label/neg_label) built by GetPairwiseCollateFn
         """
-        # Warning: we don't use segment (token type), so we treat query and passage are the same.
-        if args.triplet: 
-            inputs = {"query_ids": batch[0].long(),   "attention_mask_q": batch[1].long(),
-                      "input_ids_a": batch[3].long(), "attention_mask_a": batch[4].long(),
-                      "input_ids_b": batch[6].long(), "attention_mask_b": batch[7].long()}
-        else: # the difference is that it doesn't need batch[7] and use batch[6] as labels.
-            inputs = {"input_ids_a": batch[0].long(), "attention_mask_a": batch[1].long(),
-                      "input_ids_b": batch[3].long(), "attention_mask_b": batch[4].long(),
-                      "labels": batch[6]}
+        # Warning: we don't use segment (token type), so the collate fns do not build it.
+        if args.group_negatives: # (query, mask, pos, mask, k negatives per query, mask, neg_mask) built by GetGroupedCollateFn
+            inputs = {"query_ids": batch[0],   "attention_mask_q": batch[1],
+                      "input_ids_a": batch[2], "attention_mask_a": batch[3],
+                      "input_ids_b": batch[4], "attention_mask_b": batch[5],
+                      "neg_mask": batch[6]}
+        elif args.triplet: 
+            inputs = {"query_ids": batch[0],   "attention_mask_q": batch[1],
+                      "input_ids_a": batch[2], "attention_mask_a": batch[3],
+                      "input_ids_b": batch[4], "attention_mask_b": batch[5]}
+        else: # the difference is that it doesn't need the negative and uses batch[4] as labels.
+            inputs = {"input_ids_a": batch[0], "attention_mask_a": batch[1],
+                      "input_ids_b": batch[2], "attention_mask_b": batch[3],
+                      "labels": batch[4]}
+        if args.in_batch_negatives != "none":
+            inputs["in_batch_negatives"] = args.in_batch_negatives
+        if args.fused_encoder != "none":
+            inputs["fused_encoder"] = args.fused_encoder
+        if args.pack_length > 0: # attention masks hold segment_ids, the last six tensors locate the packed sequences
+            for k, part in enumerate(["q", "a", "b"]):
+                inputs["segment_positions_" + part], inputs["cls_index_" + part] = batch[-6 + 2 * k], batch[-5 + 2 * k]
         '''
             Forbid sync gradient with all reduce under DDP, 
             https://zhuanlan.zhihu.com/p/250471767, to speed up training again. 
@@ -225,6 +256,16 @@ def train(args, model, tokenizer, query_cache, passage_cache):
         loss = outputs[0]
         if args.n_gpu > 1: # 
             loss = loss.mean()  # mean() to average on multi-gpu parallel training
+        if args.max_tokens > 0:
+            # token budget batches differ in size: weight each mean loss by its samples, the gradients are
+            # renormalized by the samples of the whole optimizer step below
+            batch_samples = (inputs["cls_index_q"] if "cls_index_q" in inputs else batch[0]).size(0)
+            # the budget is predicted from the record lengths (see GetPartTokensFn), it has to match the collated batch
+            batch_tokens = sum(inputs[key].numel() for key in ["query_ids", "input_ids_a", "input_ids_b"] if key in inputs)
+            if batch_samples > 1 and batch_tokens > args.max_tokens:
+                raise RuntimeError("Token budget batch of {} samples holds {} tokens, over --max_tokens {}".format(batch_samples, batch_tokens, args.max_tokens))
+            step_samples += batch_samples
+            loss = loss * batch_samples / args.train_batch_size
         if args.gradient_accumulation_steps > 1:
             loss = loss / args.gradient_accumulation_steps
         # Apex
@@ -237,12 +278,26 @@ def train(args, model, tokenizer, query_cache, passage_cache):
             else:
                 with model.no_sync():
                     loss.backward() # accumulation gradient but not update parameter
-        tr_loss += loss.item()
+        step_loss += loss.item()
 
         '''
             Update model parameter with accumulation gradient
         '''
         if step % args.gradient_accumulation_steps == 0:
+            step_scale = 1.0
+            if args.max_tokens > 0:
+                if args.local_rank != -1:
+                    # DDP averaged the gradients over the ranks, every rank scales by the same mean of their sample counts
+                    step_samples = torch.tensor(step_samples, dtype=torch.float, device=args.device)
+                    dist.all_reduce(step_samples)
+                    step_samples = step_samples.item() / args.world_size
+                # mean over all samples of the step instead of over the nominal train_batch_size * gradient_accumulation_steps
+                step_scale = args.train_batch_size * args.gradient_accumulation_steps / step_samples
+                for p in (amp.master_params(optimizer) if args.fp16 else model.parameters()):
+                    if p.grad is not None:
+                        p.grad.mul_(step_scale)
+            tr_loss += step_loss * step_scale
+            step_loss, step_samples = 0.0, 0
             if args.fp16:
                 torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
             else:
@@ -289,6 +344,9 @@ def train(args, model, tokenizer, query_cache, passage_cache):
                 learning_rate_scalar = scheduler.get_lr()[0]
                 logs["learning_rate"] = learning_rate_scalar
                 logs["loss"] = loss_scalar
+                if args.record_cache_mb > 0 and args.num_workers == 0: # with workers every worker has its own cache
+                    for key, value in passage_cache.stats().items():
+                        logs["passage_cache_" + key] = value
                 tr_loss = 0
                 # only record log information in rank 0 processing
                 if is_first_worker():
@@ -352,6 +410,7 @@ def load_model(args):
                                                           do_lower_case=args.do_lower_case, # False, whether transfer words into lower case
                                                           cache_dir=None,
     )
+    args.pad_token_id = tokenizer.pad_token_id # fills packed rows, see pack_records
     # RobertaDot_NLL_LN.from_pretrained or RobertaDot_CLF_ANN_NLL_MultiChunk.pretrained
     model = configObj.model_class.from_pretrained(args.model_name_or_path,
                                                   from_tf=bool(".ckpt" in args.model_name_or_path), # from tensorflow checkpoint loading
@@ -408,13 +467,22 @@ def main():
     parser.add_argument("--do_lower_case", default=False, help="Set this flag if you are using an uncased model.",)
     # training setting
     parser.add_argument("--triplet", default=True, help="Whether to run training with (q, p_pos, p_neg).",)
+    parser.add_argument("--in_batch_negatives", default="none", type=str, choices=["none", "batch", "ranks"], help="Also score each query against the positives and negatives of the other queries in the batch, ranks: of every DDP rank (rdot_nll, needs --group_negatives when the ann data has more than one negative per query)",)
+    parser.add_argument("--fused_encoder", default="none", type=str, choices=["none", "passages", "all"], help="Encode positives and negatives (all: and queries) of a batch in one encoder pass padded to their longest sequence (rdot_nll, not with --pack_length)",)
+    parser.add_argument("--group_negatives", default=False, action="store_true", help="Train on (q, p_pos, [p_neg_1..p_neg_k]) groups with a softmax over all k negatives, each query and positive is encoded once",)
 
     parser.add_argument("--max_seq_length", default=512, type=int, help="The maximum total input sequence length after tokenization. \
                                             Sequences longer than this will be truncated, sequences shorter will be padded.",)
     parser.add_argument("--max_query_length", default=64, type=int, help="The maximum total input sequence length after tokenization. \
                                             Sequences longer than this will be truncated, sequences shorter will be padded.",)
+    parser.add_argument("--pack_length", default=0, type=int, help="Pack several queries or passages into rows of this many tokens with a block-diagonal attention mask (rdot_nll with triplets only), 0 to disable",)
+    parser.add_argument("--pad_to_multiple_of", default=8, type=int, help="Pad each batch to its longest sequence rounded up to this multiple (MaxP passages: to whole 512 chunks), 0 to always pad to the max length",)
+    parser.add_argument("--mmap_cache", default=False, action="store_true", help="Memory map the preprocessed query and passage stores instead of reading them record by record",)
+    parser.add_argument("--record_cache_mb", default=0, type=int, help="Size in MB of the LRU cache of decoded passages (hard negatives repeat across queries), 0 to disable",)
+    parser.add_argument("--num_workers", default=0, type=int, help="DataLoader workers reading and collating training batches, each gets its own share of the ann data",)
     parser.add_argument("--evaluate_during_training", default=True, help="Rul evaluation during training at each logging step.",)
     parser.add_argument("--per_gpu_train_batch_size", default=8, type=int, help="Batch size per GPU/CPU for training.",)
+    parser.add_argument("--max_tokens", default=0, type=int, help="Fill each training batch up to this many padded query + passage tokens instead of per_gpu_train_batch_size samples, 0 to disable",)
     parser.add_argument("--per_gpu_eval_batch_size", default=8, type=int, help="Batch size per GPU/CPU for evaluation.",)
     parser.add_argument("--max_steps", default=1000000, type=int, help="If > 0: set total number of training steps to perform",)
     parser.add_argument("--save_steps", type=int, default=10000, help="Save checkpoint every X updates steps.",)
@@ -439,6 +507,19 @@ def main():
     parser.add_argument("--local_rank", type=int, default=-1, help="For distributed training: local_rank",)
 
     args = parser.parse_args()
+    if args.pack_length > 0 and (hasattr(MSMarcoConfigDict[args.model_type].model_class, 'base_len') or not args.triplet):
+        raise ValueError("--pack_length needs triplet training with a model that encodes passages whole (rdot_nll)")
+    if args.pack_length > 0 and args.local_rank == -1 and torch.cuda.device_count() > 1:
+        # DataParallel would split the packed rows and cls_index (global row indices) separately
+        raise ValueError("--pack_length does not support DataParallel on several GPUs, use torch.distributed.launch or one GPU")
+    if args.in_batch_negatives != "none" and (hasattr(MSMarcoConfigDict[args.model_type].model_class, 'base_len') or not args.triplet):
+        raise ValueError("--in_batch_negatives needs triplet training with a model that encodes passages whole (rdot_nll)")
+    if args.fused_encoder != "none" and (hasattr(MSMarcoConfigDict[args.model_type].model_class, 'base_len') or not args.triplet or args.pack_length > 0):
+        raise ValueError("--fused_encoder needs unpacked triplet training with a model that encodes passages whole (rdot_nll)")
+    if args.in_batch_negatives != "none":
+        _, ann_path, _ = get_latest_ann_data(args.ann_dir) # later ann data is checked again when the trainer loads it
+        if ann_path is not None:
+            check_in_batch_negatives(args, load_ann_data(ann_path))
     
     # -----------------------------------------------------
     set_env(args) # set run env and reproducible seed
@@ -447,10 +528,10 @@ def main():
     '''
     # query 
     query_collection_path = os.path.join(args.data_dir, "preprocessed/train-query")
-    query_cache = EmbeddingCache(query_collection_path)
+    query_cache = EmbeddingCache(query_collection_path, mmap=args.mmap_cache)
     # passages
     passage_collection_path = os.path.join(args.data_dir, "preprocessed/passages")
-    passage_cache = EmbeddingCache(passage_collection_path)
+    passage_cache = EmbeddingCache(passage_collection_path, mmap=args.mmap_cache, cache_bytes=args.record_cache_mb * 1024 * 1024)
     
     '''
         Step 2: Pretrained model and tokenizer 
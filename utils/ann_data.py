@@ -0,0 +1,33 @@
+"""
+Binary ANN training data: ann_training_data_[output_num].npy holds one structured row
+(qid, pos, neg[negative_sample]) per query, int32 offsets into the preprocessed stores,
+queries with fewer negatives are padded with -1. The .npy header records the dtype and the
+number of rows, the trainer memory maps the file instead of parsing text lines.
+"""
+import numpy as np
+
+def ann_data_dtype(negative_sample):
+    return np.dtype([('qid', '<i4'), ('pos', '<i4'), ('neg', '<i4', (negative_sample,))])
+
+# qids, pos_pids: [N], neg_pids: N lists of negatives
+def build_ann_data(qids, pos_pids, neg_pids):
+    data = np.empty(len(qids), dtype=ann_data_dtype(max([len(negs) for negs in neg_pids], default=1)))
+    data['qid'] = qids
+    data['pos'] = pos_pids
+    data['neg'] = -1
+    for k, negs in enumerate(neg_pids):
+        data['neg'][k, :len(negs)] = negs
+    return data
+
+def save_ann_data(path, qids, pos_pids, neg_pids):
+    np.save(path, build_ann_data(qids, pos_pids, neg_pids))
+
+# memory mapped rows of a .npy file, the "qid \t pos_pid \t neg_pid,neg_pid,..." text of older runs is parsed into the same rows
+def load_ann_data(path):
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    with open(path, 'r') as f:
+        triplets = [line.rstrip('\n').split('\t') for line in f]
+    return build_ann_data([int(qid) for qid, _, _ in triplets],
+                          [int(pos_pid) for _, pos_pid, _ in triplets],
+                          [[int(neg_pid) for neg_pid in negs.split(',')] for _, _, negs in triplets])
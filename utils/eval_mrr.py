@@ -9,7 +9,7 @@ from tqdm import tqdm
 import torch
 import os
 from utils.util import concat_key, is_first_worker, all_gather
-from dataloader import StreamingDataset
+from dataloader import StreamingDataset, get_pad_multiple, padded_length
 from torch.utils.data import DataLoader
 
 
@@ -19,9 +19,12 @@ def embedding_inference(args, path, model, fn, bz, num_workers=2, is_query=True)
     sds = StreamingDataset(f, fn)
     loader = DataLoader(sds, batch_size=bz, num_workers=1)
     emb_list, id_list = [], []
+    pad_multiple = get_pad_multiple(args, is_query)
     model.eval()
     for i, batch in tqdm(enumerate(loader), desc="Eval", disable=args.local_rank not in [-1, 0]):
-        batch = tuple(t.to(args.device) for t in batch)
+        # trim the padding past the longest sequence of the batch
+        seq_length = padded_length(batch[1].sum(dim=1).max(), batch[0].shape[1], pad_multiple)
+        batch = tuple(t[:, :seq_length].to(args.device) if t.dim() == 2 else t.to(args.device) for t in batch)
         with torch.no_grad():
             inputs = {"input_ids": batch[0].long(), "attention_mask": batch[1].long()}
             idx = batch[3].long()
@@ -0,0 +1,96 @@
+import os
+import pickle
+import numpy as np
+
+class IdMap:
+    """
+    Compact {raw id: offset} map replacing the pickled pid2offset/qid2offset dicts.
+    Raw ids are kept sorted as int64 with their int32 offsets alongside, saved as
+    path + "_ids.npy" and path + "_offsets.npy" and memory mapped on load.
+    """
+    def __init__(self, ids, offsets):
+        self.ids = ids # sorted raw ids
+        self.offsets = offsets # offsets[i] is the offset of ids[i]
+        self.reverse_order = None # argsort of offsets, built on the first reverse lookup
+
+    @classmethod
+    def from_arrays(cls, ids, offsets):
+        ids = np.asarray(ids, dtype=np.int64)
+        order = np.argsort(ids, kind='stable')
+        return cls(ids[order], np.asarray(offsets, dtype=np.int32)[order])
+
+    @classmethod
+    def from_dict(cls, id2offset):
+        return cls.from_arrays(np.fromiter(id2offset.keys(), dtype=np.int64, count=len(id2offset)),
+                               np.fromiter(id2offset.values(), dtype=np.int32, count=len(id2offset)))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        return cls(np.load(path + "_ids.npy", mmap_mode=mmap_mode), np.load(path + "_offsets.npy", mmap_mode=mmap_mode))
+
+    def save(self, path):
+        np.save(path + "_ids.npy", self.ids)
+        np.save(path + "_offsets.npy", self.offsets)
+
+    def lookup(self, raw_ids, default=-1):
+        # vectorized raw id -> offset, ids that are not in the map get default
+        raw_ids = np.asarray(raw_ids, dtype=np.int64)
+        if len(self.ids) == 0:
+            return np.full(raw_ids.shape, default, dtype=np.int64)
+        idx = np.minimum(np.searchsorted(self.ids, raw_ids), len(self.ids) - 1)
+        return np.where(self.ids[idx] == raw_ids, self.offsets[idx], default)
+
+    def reverse_lookup(self, offsets, default=-1):
+        # vectorized offset -> raw id
+        if self.reverse_order is None:
+            self.reverse_order = np.argsort(self.offsets, kind='stable')
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if len(self.ids) == 0:
+            return np.full(offsets.shape, default, dtype=np.int64)
+        sorted_offsets = self.offsets[self.reverse_order]
+        idx = np.minimum(np.searchsorted(sorted_offsets, offsets), len(self.ids) - 1)
+        return np.where(sorted_offsets[idx] == offsets, self.ids[self.reverse_order[idx]], default)
+
+    def get(self, raw_id, default=None):
+        offset = int(self.lookup([raw_id])[0])
+        return default if offset == -1 else offset
+
+    def __getitem__(self, raw_id):
+        offset = self.get(raw_id)
+        if offset is None:
+            raise KeyError(raw_id)
+        return offset
+
+    def __contains__(self, raw_id):
+        return self.get(raw_id) is not None
+
+    def __len__(self):
+        return len(self.ids)
+
+# load data_dir/name as an IdMap, falling back to the pickled dict of older preprocessed data
+def load_id_map(data_dir, name):
+    path = os.path.join(data_dir, name)
+    if os.path.exists(path + "_ids.npy"):
+        return IdMap.load(path)
+    with open(path + ".pickle", 'rb') as handle:
+        return IdMap.from_dict(pickle.load(handle))
+
+# deduplicated passage stores (preprocessing --dedup) map the pids of dropped duplicates to the kept record through
+# store_path + "_alias"; for evaluation the k-th alias (in id order) gets its own id num_records + k, which the dev
+# qrels are written with, so every relevant pid is kept apart. Returns {record offset: [evaluation ids of its aliases]},
+# empty for stores without aliases
+def load_alias_expansion(store_path):
+    if not os.path.exists(store_path + "_alias_ids.npy"):
+        return {}
+    num_records = len(np.load(store_path + "_ids.npy", mmap_mode='r'))
+    alias_expansion = {}
+    for k, offset in enumerate(IdMap.load(store_path + "_alias").offsets.tolist()):
+        alias_expansion.setdefault(offset, []).append(num_records + k)
+    return alias_expansion
+
+# ranked record offsets -> ranked evaluation ids, every record followed by its aliases, the way a store without
+# dedup ranks identical passages next to each other
+def expand_aliases(pids, alias_expansion):
+    for pid in pids:
+        yield pid
+        yield from alias_expansion.get(int(pid), ())
@@ -63,10 +63,28 @@ def get_latest_ann_data(ann_data_path): # ann_dir
         data_no = max(data_no_list)
         with open(os.path.join(ann_data_path, ANN_PREFIX + str(data_no)), 'r') as f:
             ndcg_json = json.load(f) # ndcg_json is a dict, saved some info
-        return data_no, os.path.join(ann_data_path, "ann_training_data_" + str(data_no)), ndcg_json # ann_ndcg_[data_no]
+        ann_path = os.path.join(ann_data_path, "ann_training_data_" + str(data_no))
+        if os.path.exists(ann_path + ".npy"): # binary format, see utils/ann_data.py
+            ann_path += ".npy"
+        return data_no, ann_path, ndcg_json # ann_ndcg_[data_no]
         # generate current training ann data with max data_no, according to ndcg_json information to generate new data and then save in ann_training_data_data_no 
     return -1, None, None
 
+# write order of the triplets 0 .. len(keys) - 1 of an ANN data file
+# random: fully shuffled, locality: sorted by keys[i] (the smallest passage offset triplet i reads), cut into windows of
+# shuffle_window triplets, shuffled inside every window and in window order, so the trainer reads nearby records together
+def order_triplets(keys, ann_order="random", shuffle_window=1024):
+    order = list(range(len(keys)))
+    if ann_order == "random":
+        random.shuffle(order)
+        return order
+    order.sort(key=lambda i: keys[i])
+    windows = [order[start:start + shuffle_window] for start in range(0, len(order), shuffle_window)]
+    random.shuffle(windows)
+    for window in windows:
+        random.shuffle(window)
+    return [i for window in windows for i in window]
+
 def all_gather(data):
     """
     Run all_gather on arbitrary picklable data (not necessarily tensors)